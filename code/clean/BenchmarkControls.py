@@ -0,0 +1,215 @@
+import sys
+import time
+import resource
+import subprocess
+import multiprocessing
+from datetime import datetime
+from GetControls import *
+
+# City centres (latitude, longitude), their postcode areas, their share of transactions, and how spread out they are (in degrees)
+cities = [
+	("E", 51.51, -0.12, 0.30, 0.10),
+	("M", 53.48, -2.24, 0.10, 0.06),
+	("B", 52.48, -1.90, 0.10, 0.06),
+	("LS", 53.80, -1.55, 0.08, 0.05),
+	("L", 53.41, -2.98, 0.07, 0.05),
+	("BS", 51.45, -2.59, 0.07, 0.05),
+	("NE", 54.98, -1.61, 0.06, 0.05),
+	("S", 53.38, -1.47, 0.06, 0.05),
+	("NG", 52.95, -1.15, 0.06, 0.05),
+	("TR", 50.26, -5.05, 0.10, 0.40),
+]
+
+def make_synthetic_data(n_properties, extension_share=0.1, seed=0):
+	'''
+	generate UK-like transactions for benchmarking the control search: properties clustered around cities, with 2 to 4 transactions each, leases that run down over time, and lease extensions.
+	returns one row per transaction with a previous transaction, as in for_controls.csv
+
+	n_properties : int
+		number of properties
+	extension_share : float
+		share of properties whose lease is extended before their last sale
+	seed : int
+		random seed
+	'''
+	rng = np.random.default_rng(seed)
+
+	# Locations, snapped to a grid so that some properties share coordinates (as within a postcode)
+	city = rng.choice(len(cities), size=n_properties, p=np.array([c[3] for c in cities]) / sum(c[3] for c in cities))
+	area = np.array([c[0] for c in cities])[city]
+	latitude = np.round(np.array([c[1] for c in cities])[city] + rng.normal(0, 1, n_properties) * np.array([c[4] for c in cities])[city], 3)
+	longitude = np.round(np.array([c[2] for c in cities])[city] + rng.normal(0, 1.6, n_properties) * np.array([c[4] for c in cities])[city], 3)
+	district = rng.integers(1, 30, n_properties)
+
+	# Lease terms at the start of the data and a premium for each property
+	lease_length = rng.choice([99, 125, 150, 250, 999], size=n_properties, p=[0.4, 0.3, 0.1, 0.1, 0.1])
+	lease_age = rng.integers(0, 40, n_properties)
+	premium = rng.normal(0, 0.4, n_properties) + np.where(area == "E", 0.6, 0)
+
+	# Transaction years, at least a year apart
+	n_transactions = rng.integers(2, 5, n_properties)
+	gaps = rng.integers(1, 9, (n_properties, 4))
+	gaps[:, 0] = rng.integers(1995, 2016, n_properties)
+	years = np.cumsum(gaps, axis=1)
+	months = rng.integers(1, 13, (n_properties, 4))
+
+	# One row per pair of consecutive transactions
+	properties, sales = np.nonzero((np.arange(1, 4)[None, :] < n_transactions[:, None]) & (years[:, 1:] <= 2023))
+	sales = sales + 1
+	year, L_year = years[properties, sales], years[properties, sales - 1]
+	month, L_month = months[properties, sales], months[properties, sales - 1]
+	is_last = np.r_[properties[1:] != properties[:-1], True]
+	extension = (is_last & (rng.random(n_properties) < extension_share)[properties]).astype(int)
+
+	L_duration = lease_length[properties] - lease_age[properties] - (L_year - 1995) + rng.random(len(properties))
+	whb_duration = lease_length[properties] - lease_age[properties] - (year - 1995) + rng.random(len(properties))
+	duration = whb_duration + 90 * extension
+
+	trend = 0.05 * (np.arange(1995, 2030) - 1995)
+	log_price = 11 + premium[properties] + trend[year - 1995] + 0.002 * np.minimum(duration, 150) + rng.normal(0, 0.2, len(properties))
+	L_log_price = 11 + premium[properties] + trend[L_year - 1995] + 0.002 * np.minimum(L_duration, 150) + rng.normal(0, 0.2, len(properties))
+
+	df = pd.DataFrame({
+		"property_id": [f"{p} {a} STREET" for p, a in zip(properties, area[properties])],
+		"date_trans": [f"{y}-{m:02d}-15" for y, m in zip(year, month)],
+		"postcode": [f"{a}{d} {p % 9}AA" for a, d, p in zip(area[properties], district[properties], properties)],
+		"outcode": [f"{a}{d}" for a, d in zip(area[properties], district[properties])],
+		"area": area[properties],
+		"latitude": latitude[properties],
+		"longitude": longitude[properties],
+		"year": year,
+		"L_year": L_year,
+		"quarter": (month - 1) // 3 + 1,
+		"L_quarter": (L_month - 1) // 3 + 1,
+		"month": month,
+		"L_month": L_month,
+		"years_held": year - L_year,
+		"duration": np.round(duration, 2),
+		"L_duration": np.round(L_duration, 2),
+		"whb_duration": np.round(whb_duration, 2),
+		"duration10yr": (duration // 10 * 10).astype(int),
+		"log_price": log_price,
+		"L_log_price": L_log_price,
+		"extension": extension,
+	})
+	for tag in ["_bedrooms", "_all", "_linear"]:
+		df[f"pres{tag}"] = np.where(rng.random(len(df)) < 0.9, log_price - 11 + rng.normal(0, 0.1, len(df)), np.nan)
+	# A few properties are missing their coordinates
+	df.loc[rng.random(len(df)) < 0.001, ["latitude", "longitude"]] = np.nan
+	return df.loc[df["duration"] > 0].reset_index(drop=True)
+
+def get_peak_memory(who=resource.RUSAGE_SELF):
+	'''
+	get the peak resident memory of this process (or the largest of its finished children) in megabytes
+
+	who : int
+		resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN
+	'''
+	peak = resource.getrusage(who).ru_maxrss
+	return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+def run_benchmark(n_properties, num_processes, seed=0, queue=None):
+	'''
+	time the control stage of GetControls.py (wrapper with all its variants, and get_nearest_controls) on synthetic data.
+	meant to run in its own process, so that the peak memory is that of this run alone
+
+	n_properties : int
+		number of properties to generate
+	num_processes : int
+		number of processes for wrapper
+	seed : int
+		random seed
+	queue : Queue
+		queue to put the results in (returned if None)
+	'''
+	df = make_synthetic_data(n_properties, seed=seed)
+	tags = ["_bedrooms","_all", "_linear"]
+	variants = [{"tag": "", "price_var": "log_price"}] + [{"tag": tag, "price_var": f"pres{tag}"} for tag in tags] + [{"tag": "_quarterly", "price_var": "log_price", "restrict_quarter": True}]
+
+	start = time.time()
+	extensions_by_tag = wrapper(df, variants=variants, func=apply_get_controls, num_processes=num_processes)
+	for tag, extensions in extensions_by_tag.items():
+		get_nearest_controls(extensions, tag=tag)
+	seconds = time.time() - start
+
+	n_extensions = int((df["extension"] == 1).sum())
+	result = {
+		"n_rows": len(df),
+		"n_extensions": n_extensions,
+		"n_controls": len(df) - n_extensions,
+		"cores": num_processes,
+		"seconds": seconds,
+		"rows_per_sec": len(df) / seconds,
+		"extensions_per_sec": n_extensions / seconds,
+		"peak_memory_mb": get_peak_memory(resource.RUSAGE_SELF),
+		"worker_peak_memory_mb": get_peak_memory(resource.RUSAGE_CHILDREN),
+	}
+	if queue is None:
+		return result
+	queue.put(result)
+
+def get_version():
+	'''
+	get the current git commit of the code, to tell apart the benchmarks of different versions (empty if not in a git repository)
+	'''
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+	except OSError:
+		return ""
+
+def compare_benchmarks(file):
+	'''
+	print the throughput of every version benchmarked in a results file, by data size and number of cores
+
+	file : string
+		results file
+	'''
+	results = pd.read_csv(file)
+	results["version"] = results["commit"].fillna("").astype(str) + " " + results["label"].fillna("").astype(str)
+	print(results.pivot_table(index=["n_properties", "cores"], columns="version", values="rows_per_sec", aggfunc="median", sort=False).round(1))
+
+if __name__ == "__main__":
+
+	print("Runnning...")
+
+	output_folder = os.path.join(working_folder, "benchmarks")
+	os.makedirs(output_folder, exist_ok=True)
+	outfile = os.path.join(output_folder, "control_benchmarks.csv")
+
+	# Data sizes (number of properties) and core counts to benchmark, and a label for this version of the code
+	sizes = [5000, 20000, 80000]
+	cores = sorted(set([1, 2, 4, os.cpu_count()]))
+	label = ""
+
+	########################################################################
+	results = []
+	for n_properties in sizes:
+		for num_processes in cores:
+			print(f"Benchmarking {n_properties} properties on {num_processes} cores")
+
+			# Run each benchmark in a fresh process, so that its peak memory is not mixed up with the other runs
+			queue = multiprocessing.get_context("spawn").Queue()
+			process = multiprocessing.get_context("spawn").Process(target=run_benchmark, args=(n_properties, num_processes), kwargs={"queue": queue})
+			process.start()
+			process.join()
+			if process.exitcode != 0:
+				print(f"Benchmark failed with exit code {process.exitcode}.")
+				continue
+			results.append({"n_properties": n_properties, **queue.get()})
+
+	# Scaling efficiency relative to the run with the fewest cores on the same data
+	results = pd.DataFrame(results)
+	base_seconds = results.sort_values("cores").groupby("n_properties")["seconds"].transform("first")
+	base_cores = results.sort_values("cores").groupby("n_properties")["cores"].transform("first")
+	results["speedup"] = base_seconds / results["seconds"]
+	results["efficiency"] = results["speedup"] / (results["cores"] / base_cores)
+	results.insert(0, "label", label)
+	results.insert(0, "commit", get_version())
+	results.insert(0, "date", datetime.now().strftime("%Y-%m-%d %H:%M"))
+	print(results)
+
+	# Save, adding to the results of previous versions
+	results.to_csv(outfile, mode="a", header=not os.path.exists(outfile), index=False)
+	print(f"Saved to {outfile}:")
+	compare_benchmarks(outfile)
+	########################################################################
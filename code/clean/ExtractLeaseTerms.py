@@ -6,6 +6,9 @@ import os
 import sys
 from textblob import TextBlob
 from dateutil.parser import parse
+from datetime import datetime
+import hashlib
+import inspect
 from math import ceil 
 from spellchecker import SpellChecker
 from tqdm import tqdm
@@ -52,6 +55,12 @@ MONTHS = [
 spell_months = SpellChecker(language=None)
 spell_months.word_frequency.load_words(MONTHS)
 
+# Date fields missing from a term (e.g. the day in "from june 1990") are taken from this date, rather than from today as dateutil does by default
+DEFAULT_DATE = datetime(1900, 1, 1)
+
+# Version of the lease term cache, bump it to discard the cached terms when something they depend on changes outside this file (e.g. the spelling corpora)
+CACHE_VERSION = 1
+
 def extract_number(text):
 	'''
 	identifies whether there is a number in a string
@@ -213,7 +222,7 @@ def get_date(text, key_words = ['from','commencing','starting','beginning'], end
 			if parse_date:
 				# Get date
 				try:
-					date = parse(submatch, fuzzy=True)
+					date = parse(submatch, fuzzy=True, default=DEFAULT_DATE)
 					return date.strftime('%m-%d-%Y'), submatch
 				except:
 					# If could not get date, use year 
@@ -268,7 +277,7 @@ def get_number_years(text, date_from=None, date_to=None):
 		number_years = int(re.search('[1-9][0-9]?[0-9]?[0-9]?', match).group())
 		return number_years 
 	elif date_from and date_to:
-		t = parse(date_to, fuzzy=True) - parse(date_from, fuzzy=True)
+		t = parse(date_to, fuzzy=True, default=DEFAULT_DATE) - parse(date_from, fuzzy=True, default=DEFAULT_DATE)
 		return t.days/365
 	return None
 
@@ -313,28 +322,50 @@ def date_from_is_registration(text):
 	return False
 
 
-def extract_term(original_text, date_registered=None):
+def normalize_term(original_text):
 	'''
-	extract relevant information about a lease from the recorded text field
+	normalize the case, punctuation and spacing of the recorded text field, which is all that extract_term depends on
 	
 	original_text : string
 		raw text recorded in the lease document
-	date_registered : Date
-		date that lease was registered
 	'''
-
-	if type(original_text) != str:
-		return [None, None, None]
-
 	text = original_text.lower()
 	text = text.replace(',','').replace('.','-').replace('~','').replace(' year ', ' years ')
-	text = " ".join(text.split())
+	return " ".join(text.split())
+
+def clean_term(text):
+	'''
+	correct typos, holidays and spelled out numbers in a normalized text field (the slow part of extract_term)
+	
+	text : string
+		text from normalize_term
+	'''
 	text = remove_cardinal_numbers(text)
 	text = correct_holidays(text)
 	text = correct_months(text)
 	text = correct_typos(text)
 	text = extract_number(text)
+	return text
 
+def uses_date_registered(text):
+	'''
+	check if the lease origination date is the registration date, in which case the lease term depends on the registration date
+	
+	text : string
+		text from clean_term
+	'''
+	_, number_years_str = get_number_years_exact(text)
+	return date_from_is_registration(text.replace(number_years_str, ""))
+
+def parse_term(text, date_registered=None):
+	'''
+	extract the lease length, origination date and end date from a cleaned text field
+	
+	text : string
+		text from clean_term
+	date_registered : Date
+		date that lease was registered
+	'''
 	substring = text
 
 	number_years, number_years_str = get_number_years_exact(substring)
@@ -370,6 +401,24 @@ def extract_term(original_text, date_registered=None):
 		substring = add_years(substring)
 		number_years = get_number_years(substring, date_from=date_from, date_to=date_to)
 
+	return [number_years, date_from, date_to]
+
+def extract_term(original_text, date_registered=None):
+	'''
+	extract relevant information about a lease from the recorded text field
+	
+	original_text : string
+		raw text recorded in the lease document
+	date_registered : Date
+		date that lease was registered
+	'''
+
+	if type(original_text) != str:
+		return [None, None, None]
+
+	text = clean_term(normalize_term(original_text))
+	number_years, date_from, date_to = parse_term(text, date_registered=date_registered)
+
 	if number_years == None and date_from==None and date_to==None:
 		out ='\n\n\n---------------------------------------------------'
 		out += "\nCould not parse the following text:"
@@ -414,9 +463,140 @@ def parallelize(df, function=apply_extract_term):
 	df_processed = pd.concat(processed_chunks, ignore_index=True)
 	return df_processed
 
+def get_rules_version():
+	'''
+	get a version of the rules used to extract lease terms, which changes whenever the source of any of them (or CACHE_VERSION) changes, so that terms extracted with other rules are not reused
+	'''
+	rules = [extract_number, correct_months, correct_typos, remove_cardinal_numbers, correct_holidays, get_date, get_date_from, get_date_start, get_date_to, get_number_years, get_number_years_exact, add_years, date_from_is_registration, normalize_term, clean_term, uses_date_registered, parse_term]
+	source = "".join(inspect.getsource(rule) for rule in rules) + repr([text_to_num, MONTHS, DEFAULT_DATE, CACHE_VERSION])
+	return hashlib.sha1(source.encode()).hexdigest()
+
+def load_term_cache(cache_file, version):
+	'''
+	load the lease terms extracted in previous runs (empty if there are none, or if they were extracted with other rules).
+	each term is identified by its normalized text, and by the repr of its registration date if the term starts at it (otherwise the date is "")
+
+	cache_file : string
+		cache file (no cache if None)
+	version : string
+		version of the extraction rules, from get_rules_version
+	'''
+	if cache_file is not None and os.path.exists(cache_file):
+		try:
+			cache = pd.read_pickle(cache_file)
+			if type(cache) == dict and cache.get("version") == version:
+				return cache["terms"]
+			print("Lease term cache was built with other extraction rules, starting a new one:", cache_file)
+		except Exception:
+			print("Could not read lease term cache, starting a new one:", cache_file)
+	return pd.DataFrame(columns=["text", "date", "number_years", "date_from", "date_to", "last_used"], dtype=object)
+
+def save_term_cache(cache, cache_file, version, max_size=5000000):
+	'''
+	save the lease term cache with the version of the rules its terms were extracted with, evicting the terms used least recently if there are more than max_size
+
+	cache : DataFrame
+		lease term cache from load_term_cache
+	cache_file : string
+		cache file
+	version : string
+		version of the extraction rules, from get_rules_version
+	max_size : int
+		maximum number of terms to keep
+	'''
+	if len(cache.index) > max_size:
+		print(f"Evicting {len(cache.index) - max_size} lease terms from the cache")
+		cache = cache.sort_values("last_used", ascending=False, kind="stable").iloc[:max_size]
+
+	# Write to a temporary file first so that an interrupted run never leaves a partial cache
+	os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+	pd.to_pickle({"version": version, "terms": cache.reset_index(drop=True)}, f"{cache_file}.tmp")
+	os.replace(f"{cache_file}.tmp", cache_file)
+
+def apply_extract_terms(chunk):
+	'''
+	extract the lease terms of distinct normalized texts, cleaning each text only once.
+	returns one entry for each text, or for each of its registration dates if the term starts at it
+
+	chunk : DataFrame
+		normalized texts (text) and the distinct registration dates they appear with (dates)
+	'''
+	entries = []
+	for text, dates in tqdm(zip(chunk["text"], chunk["dates"]), total=len(chunk.index)):
+		cleaned = clean_term(text)
+		if not uses_date_registered(cleaned):
+			entries.append([text, ""] + parse_term(cleaned))
+			continue
+		for date in dates:
+			entries.append([text, repr(date)] + parse_term(cleaned, date_registered=date))
+	return pd.DataFrame(entries, columns=["text", "date", "number_years", "date_from", "date_to"], dtype=object)
+
+def lookup_terms(cache, texts, dates):
+	'''
+	get the position in the cache of the term of each row (-1 if it is not in the cache)
+
+	cache : DataFrame
+		lease term cache from load_term_cache
+	texts : array (string)
+		normalized text of each row
+	dates : array (string)
+		repr of the registration date of each row
+	'''
+	index = pd.MultiIndex.from_arrays([cache["text"].values, cache["date"].values])
+	positions = index.get_indexer(pd.MultiIndex.from_arrays([texts, np.full(len(texts), "", dtype=object)]))
+	return np.where(positions >= 0, positions, index.get_indexer(pd.MultiIndex.from_arrays([texts, dates])))
+
+def extract_terms(df, cache_file=None, max_cache_size=5000000):
+	'''
+	extract the lease terms of a data set as apply_extract_term does, but only once for each distinct term: terms are identified by their normalized text, and by their registration date only if they start at it.
+	terms are looked up in (and added to) a cache on disk shared across runs, so that after a data update only the new terms are extracted
+
+	df : DataFrame
+		data with the recorded text field (Term) and the registration date (date_registered)
+	cache_file : string
+		cache file (only distinct terms within this data set if None)
+	max_cache_size : int
+		maximum number of terms to keep in the cache (the least recently used are evicted)
+	'''
+	texts = np.array([normalize_term(text) if type(text) == str else None for text in df['Term']], dtype=object)
+	is_text = np.array([text is not None for text in texts], dtype=bool)
+	date_values = df['date_registered'].values[is_text]
+	texts, dates = texts[is_text], np.array([repr(date) for date in date_values], dtype=object)
+
+	version = get_rules_version()
+	cache = load_term_cache(cache_file, version)
+	positions = lookup_terms(cache, texts, dates)
+	hits = positions >= 0
+	n_cached = len(np.unique(positions[hits]))
+
+	# Extract the terms that are not in the cache, once for each distinct text (with the distinct dates it appears with), in parallel
+	dates_by_text = {}
+	for text, date_key, date in zip(texts[~hits], dates[~hits], date_values[~hits]):
+		dates_by_text.setdefault(text, {}).setdefault(date_key, date)
+	if len(dates_by_text) > 0:
+		tasks = pd.DataFrame({"text": list(dates_by_text), "dates": [list(text_dates.values()) for text_dates in dates_by_text.values()]})
+		cache = pd.concat([cache, parallelize(tasks, function=apply_extract_terms)], ignore_index=True)
+		positions = lookup_terms(cache, texts, dates)
+
+	n_distinct = len(np.unique(positions))
+	print(f"Lease terms: {len(df.index)} rows, {len(texts)} with text and {n_distinct} distinct")
+	print(f"Cache hits: {hits.mean() if len(texts) > 0 else 0:.1%} of rows and {n_cached/max(n_distinct, 1):.1%} of distinct terms, extracting {len(dates_by_text)} new texts")
+
+	entries = cache[["number_years", "date_from", "date_to"]].values.tolist()
+	terms = iter([entries[position] for position in positions])
+	df[['number_years', 'date_from', 'date_to']] = pd.DataFrame([next(terms) if is_term else [None, None, None] for is_term in is_text], index=df.index)
+
+	if cache_file is not None:
+		cache.loc[np.unique(positions), "last_used"] = time.time()
+		save_term_cache(cache, cache_file, version, max_size=max_cache_size)
+	return df
+
 
 if __name__ == "__main__":
 
+	# Lease terms extracted in previous runs, so that after a data update only the new terms are extracted
+	cache_file = os.path.join(working_folder, "lease_term_cache.pkl")
+
 	###########################
 	# Existing lease titles
 	###########################
@@ -427,7 +607,7 @@ if __name__ == "__main__":
 	df.loc[~df['Date of Lease'].isna(),['month_registered']] = df['Date of Lease'].loc[~df['Date of Lease'].isna()].astype(str).str[3:5].astype(int)
 	df = df.rename(columns={'Date of Lease' : 'date_registered'})
 
-	df = parallelize(df)
+	df = extract_terms(df, cache_file=cache_file)
 	output_file = os.path.join(working_folder, 'extracted_terms_open.csv')
 	df.to_csv(output_file)
 
@@ -449,7 +629,7 @@ if __name__ == "__main__":
 	df['Term'] = df['Term'].str.replace("_x000D_", " ")
 	df['Term'] = df['Term'].replace(r'\s+|\\n', ' ', regex=True) 
 
-	df = parallelize(df)
+	df = extract_terms(df, cache_file=cache_file)
 	output_file = os.path.join(working_folder, 'extracted_terms_closed.csv')
 	df.to_csv(output_file)
 
@@ -461,7 +641,7 @@ if __name__ == "__main__":
 	df = df.rename(columns={'Date Registered' : 'date_registered', 'Registered Lease Details':'Term', 'Client Reference':'transaction_id'})
 	df['date_registered'] = pd.to_datetime(df['date_registered'], format='mixed')
 	df['date_registered'] = df['date_registered'].dt.strftime('%d/%m/%Y')
-	df = parallelize(df)
+	df = extract_terms(df, cache_file=cache_file)
 	output_file = os.path.join(working_folder, 'extracted_terms_other.csv')
 	df.to_csv(output_file, index=False)
 
@@ -1,15 +1,15 @@
 from utils import *
 
-def get_controls(row, purchase_controls=None, sale_controls=None, price_var='log_price', pduration_var='L_duration', sduration_var='whb_duration', restrict_quarter=False, restrict_month=False, restrictions=[0.1,0.5,1,5,10,20], margin=0.1, verbose=False):
+def get_controls(row, purchase_controls=None, sale_controls=None, price_var='log_price', pduration_var='L_duration', sduration_var='whb_duration', restrict_quarter=False, restrict_month=False, restrictions=[0.1,0.5,1,5,10,20], margin=0.1, verbose=False, purchase_neighbours=None, sale_neighbours=None, variants=None, trace=None, profile=None):
 	'''
 	identify controls that are geographically close to a treated property, have a similar duration, and transacted at the same time 
 	
 	row : Series
 		data for treated property
-	purchase_controls : DataFrame
-		data pool from which to pick purchase control properties 
-	sale_controls : DataFrame 
-		data pool from which to pick sale control properties 
+	purchase_controls : DataFrame or dict
+		data pool from which to pick purchase control properties (or the output of index_control_pool)
+	sale_controls : DataFrame or dict
+		data pool from which to pick sale control properties (or the output of index_control_pool)
 	price_var : string
 		outcome variable to report for controls
 	pduration_var : string 
@@ -24,57 +24,214 @@ def get_controls(row, purchase_controls=None, sale_controls=None, price_var='log
 		the maximum difference between the treated and control duration 
 	verbose : bool 
 		flag for whether to print output 
+	purchase_neighbours : tuple (array, array)
+		positions of (and distances to) purchase controls within the largest radius, from get_block_neighbours (computed here if not provided)
+	sale_neighbours : tuple (array, array)
+		positions of (and distances to) sale controls within the largest radius, from get_block_neighbours (computed here if not provided)
+	variants : list (dict)
+		outcome variables and time restrictions for which to report controls, as dictionaries with keys "price_var" and (optionally) "restrict_quarter" and "restrict_month".
+		variants with "matches" set to True report the matched controls from get_matches_by_radius instead of the indices, with their own "margin" if given.
+		if provided, price_var, restrict_quarter and restrict_month are ignored and the output for each variant is reported one after the other
+	trace : dict
+		tracing settings from start_trace (no tracing if None)
+	profile : dict
+		seconds spent in each stage of the search, to which the time spent on this property is added (no profiling if None)
 	'''
 
-	text = f'\n\n{row["property_id"]} with purchase duration {row["L_duration"]} and sale duration {row["duration"]}, held for {row["years_held"]}, purchased in {row["L_year"]} and sold in {row["year"]}.\n'
- 
-	postcode = row['postcode']
-	lat_rad = row['lat_rad']
-	lon_rad = row['lon_rad']
-	outcode = row['outcode']
+	if verbose:
+		text = f'\n\n{row["property_id"]} with purchase duration {row["L_duration"]} and sale duration {row["duration"]}, held for {row["years_held"]}, purchased in {row["L_year"]} and sold in {row["year"]}.\n'
+	traced = trace is not None and should_trace(row["property_id"], trace)
 
 	output = []
-	keys = ["property_id", "year", "L_year", "duration", "L_duration", "distance", price_var, "F1_extension"]
-
-	# Remove *this* property from controls
-	purchase_controls = purchase_controls[purchase_controls.property_id != row.property_id]
-	sale_controls = sale_controls[sale_controls.property_id != row.property_id]
+	keys = ["property_id", "year", "L_year", "duration", "L_duration", "distance", price_var]
 
 	# If not already sorted backwards,sort restrictions backwards
 	restrictions.sort(reverse=True)
-	purchase_controls["distance"] = purchase_controls.apply(lambda row: haversine(lat_rad, lon_rad, row["lat_rad"], row["lon_rad"]), axis=1)
-	sale_controls["distance"] = sale_controls.apply(lambda row: haversine(lat_rad, lon_rad, row["lat_rad"], row["lon_rad"]), axis=1)
+
+	# Sort and index the pools, if this has not been done already
+	purchase_pool = as_control_pool(purchase_controls)
+	sale_pool = purchase_pool if sale_controls is purchase_controls else as_control_pool(sale_controls)
+
+	# Get controls within the largest radius (excluding *this* property)
+	if purchase_neighbours is None:
+		purchase_neighbours = get_block_neighbours(pd.DataFrame([row]), purchase_pool["data"], restrictions[0], index=purchase_pool["index"])[0]
+	if sale_neighbours is None:
+		sale_neighbours = get_block_neighbours(pd.DataFrame([row]), sale_pool["data"], restrictions[0], index=sale_pool["index"])[0]
 
 	#########################################################
 	# Restrict data set to that relevant for this row
 	#########################################################
 
-	for i, restriction in enumerate(restrictions):
-		text += str(restriction) + "\n"
-		text += "-----------\n"
+	if variants is None:
+		variants = [{"price_var": price_var, "restrict_quarter": restrict_quarter, "restrict_month": restrict_month}]
 
-		purchase_controls = restrict_by_location(purchase_controls, restriction=restriction)
-		sale_controls = restrict_by_location(sale_controls, restriction=restriction)
-
-		purchase_data, sale_data, text = get_restricted_data(purchase_controls, sale_controls, row, margin=margin, pduration_var=pduration_var, sduration_var=sduration_var, restrict_quarter=restrict_quarter, restrict_month=restrict_month, text=text)
-
-		for dataset in [purchase_data, sale_data]:
-			if dataset[price_var].count() > 0:
-				# Add index
-				output.append(dataset[price_var].mean())
-				# Add mean duration
-				output.append(dataset['duration'].mean())
-			else:
-				output.append(None)
-				output.append(None)
+	# The year and duration restrictions are shared by all variants (unless they have their own margin)
+	all_purchase_neighbours, all_sale_neighbours = purchase_neighbours, sale_neighbours
+	with profile_stage(profile, "restriction"):
+		purchase_neighbours = restrict_control_pool(purchase_pool, all_purchase_neighbours, year=row["L_year"], duration=row[pduration_var], margin=margin)
+		sale_neighbours = restrict_control_pool(sale_pool, all_sale_neighbours, year=row["year"], duration=row[sduration_var], margin=margin)
 
+	if verbose:
+		text += "\n\nPurchase controls:\n"
+		text += str(select_neighbours(purchase_pool["data"], purchase_neighbours)[keys]) + "\n\n"
+		text += "\n\nSale controls:\n"
+		text += str(select_neighbours(sale_pool["data"], sale_neighbours)[keys]) + "\n\n"
+
+	for variant in variants:
+		if variant.get("matches", False):
+			with profile_stage(profile, "aggregation"):
+				output.extend(get_matches_by_radius(row, purchase_pool, sale_pool, all_purchase_neighbours, all_sale_neighbours, price_var=variant["price_var"], pduration_var=pduration_var, sduration_var=sduration_var, restrictions=restrictions, margin=variant.get("margin", margin)))
+			if traced:
+				variant_purchase_neighbours = restrict_control_pool(purchase_pool, all_purchase_neighbours, year=row["L_year"], duration=row[pduration_var], margin=variant.get("margin", margin))
+				variant_sale_neighbours = restrict_control_pool(sale_pool, all_sale_neighbours, year=row["year"], duration=row[sduration_var], margin=variant.get("margin", margin))
+				write_trace(trace, get_trace_record(row, variant, purchase_pool, sale_pool, variant_purchase_neighbours, variant_sale_neighbours, restrictions))
+			continue
+
+		quarters = [row["L_quarter"], row["quarter"]] if variant.get("restrict_quarter", False) else [None, None]
+		months = [row["L_month"], row["month"]] if variant.get("restrict_month", False) else [None, None]
+		with profile_stage(profile, "restriction"):
+			variant_purchase_neighbours = restrict_control_pool(purchase_pool, purchase_neighbours, quarter=quarters[0], month=months[0])
+			variant_sale_neighbours = restrict_control_pool(sale_pool, sale_neighbours, quarter=quarters[1], month=months[1])
+
+		# Get the mean price and duration within every radius in a single pass over the controls
+		with profile_stage(profile, "aggregation"):
+			purchase_means = get_means_by_radius(purchase_pool, variant_purchase_neighbours, price_var=variant["price_var"], restrictions=restrictions)
+			sale_means = get_means_by_radius(sale_pool, variant_sale_neighbours, price_var=variant["price_var"], restrictions=restrictions)
+		for i, restriction in enumerate(restrictions):
+			output.extend(purchase_means[i] + sale_means[i])
+
+		if traced:
+			write_trace(trace, get_trace_record(row, variant, purchase_pool, sale_pool, variant_purchase_neighbours, variant_sale_neighbours, restrictions))
 
-	text += "Output: " + str(output) + "\n"
 	if verbose:
+		text += "Output: " + str(output) + "\n"
 		print(text)
 	return output
 
-def apply_get_controls(inp, restrictions=[0.1,0.5,1,5,10,20], func=get_controls):
+def get_trace_record(row, variant, purchase_pool, sale_pool, purchase_neighbours, sale_neighbours, restrictions):
+	'''
+	get a trace record of the control search for one treated property and variant: the number of controls (with a price) and their mean price and duration within every radius, 
+	and the controls within the smallest radius with both purchase and sale controls
+
+	row : Series
+		data for treated property
+	variant : dict
+		variant of the control search
+	purchase_pool : dict
+		control pool for purchase controls, from index_control_pool
+	sale_pool : dict
+		control pool for sale controls, from index_control_pool
+	purchase_neighbours : tuple (array, array)
+		positions of (and distances to) purchase controls, restricted for this variant
+	sale_neighbours : tuple (array, array)
+		positions of (and distances to) sale controls, restricted for this variant
+	restrictions : list (float)
+		the radii within which to look for controls
+	'''
+	radii = sorted(restrictions)
+	record = {"property_id": row["property_id"], "date_trans": row["date_trans"], "year": row["year"], "L_year": row["L_year"], "variant": variant.get("tag", ""), "radii": [], "selected": None}
+
+	sides = {}
+	for side, pool, (positions, distances) in [("purchase", purchase_pool, purchase_neighbours), ("sale", sale_pool, sale_neighbours)]:
+		has_price = ~np.isnan(pool["data"][variant["price_var"]].values[positions].astype(float))
+		sides[side] = (pool, positions[has_price], distances[has_price], get_means_by_radius(pool, (positions, distances), price_var=variant["price_var"], restrictions=radii))
+
+	for i, radius in enumerate(radii):
+		entry = {"radius": radius}
+		for side, prefix in [("purchase", "L_"), ("sale", "")]:
+			pool, positions, distances, means = sides[side]
+			entry[f"n_{side}"] = int((distances < radius).sum())
+			entry[f"{prefix}index"], entry[f"{prefix}duration_idx"] = means[i]
+		record["radii"].append(entry)
+
+		if record["selected"] is None and entry["n_purchase"] > 0 and entry["n_sale"] > 0:
+			record["selected"] = {"radius": radius}
+			for side in ["purchase", "sale"]:
+				pool, positions, distances, _ = sides[side]
+				pids, dates = get_matches(pool, positions[distances < radius])
+				record["selected"][f"{side}_controls"] = [[pid, date] for pid, date in zip(pids, dates)]
+	return record
+
+def get_matches_by_radius(row, purchase_pool, sale_pool, purchase_neighbours, sale_neighbours, price_var='log_price', pduration_var='L_duration', sduration_var='whb_duration', restrictions=[0.1,0.5,1,5,10,20], margin=0.1):
+	'''
+	get the purchase and sale controls (with a price) within the smallest radius in which there are both
+	returns the property_ids and dates of the purchase controls and of the sale controls, from get_matches (empty if there are none within any radius)
+
+	row : Series
+		data for treated property
+	purchase_pool : dict
+		control pool for purchase controls, from index_control_pool
+	sale_pool : dict
+		control pool for sale controls, from index_control_pool
+	purchase_neighbours : tuple (array, array)
+		positions of (and distances to) purchase controls within the largest radius
+	sale_neighbours : tuple (array, array)
+		positions of (and distances to) sale controls within the largest radius
+	price_var : string
+		controls without this outcome variable are ignored
+	pduration_var : string 
+		purchase duration key 
+	sduration_var : string 
+		sale duration key 
+	restrictions : list (float)
+		the radii within which to look for controls
+	margin : float 
+		the maximum difference between the treated and control duration 
+	'''
+	purchase_positions, purchase_distances = restrict_control_pool(purchase_pool, purchase_neighbours, year=row["L_year"], duration=row[pduration_var], margin=margin)
+	sale_positions, sale_distances = restrict_control_pool(sale_pool, sale_neighbours, year=row["year"], duration=row[sduration_var], margin=margin)
+
+	has_price = ~np.isnan(purchase_pool["data"][price_var].values[purchase_positions].astype(float))
+	purchase_positions, purchase_distances = purchase_positions[has_price], purchase_distances[has_price]
+	has_price = ~np.isnan(sale_pool["data"][price_var].values[sale_positions].astype(float))
+	sale_positions, sale_distances = sale_positions[has_price], sale_distances[has_price]
+
+	for restriction in sorted(restrictions):
+		purchase_data = purchase_positions[purchase_distances < restriction]
+		sale_data = sale_positions[sale_distances < restriction]
+		if len(purchase_data) > 0 and len(sale_data) > 0:
+			return [get_matches(purchase_pool, purchase_data), get_matches(sale_pool, sale_data)]
+
+	no_matches = (np.array([], dtype=object), np.array([], dtype=object))
+	return [no_matches, no_matches]
+
+def get_means_by_radius(pool, neighbours, price_var='log_price', restrictions=[0.1,0.5,1,5,10,20]):
+	'''
+	get the mean price and mean duration of the controls within each radius (ignoring controls without a price), by sorting them by distance once and taking cumulative sums
+	returns a list with one [index, duration_idx] pair per radius ([None, None] if there are no controls with a price)
+	
+	pool : dict
+		control pool from index_control_pool
+	neighbours : tuple (array, array)
+		positions of (and distances to) the controls in the pool 
+	price_var : string
+		outcome variable to report for controls
+	restrictions : list (float)
+		the radii within which to look for controls
+	'''
+	positions, distances = neighbours
+	order = np.argsort(distances, kind="stable")
+	positions, distances = positions[order], distances[order]
+
+	prices = pool["data"][price_var].values[positions].astype(float)
+	has_price = ~np.isnan(prices)
+
+	price_sum = np.cumsum(np.where(has_price, prices, 0))
+	price_count = np.cumsum(has_price)
+	duration_sum = np.cumsum(np.where(has_price, pool["duration"][positions], 0))
+
+	# Number of controls strictly within each radius
+	counts = np.searchsorted(distances, restrictions, side="left")
+
+	means = []
+	for n in counts:
+		if n > 0 and price_count[n-1] > 0:
+			means.append([price_sum[n-1] / price_count[n-1], duration_sum[n-1] / price_count[n-1]])
+		else:
+			means.append([None, None])
+	return means
+
+def apply_get_controls(inp, restrictions=[0.1,0.5,1,5,10,20], func=get_controls, max_pairs=2**22):
 	'''
 	wrapper for function to get control properties
 	
@@ -84,11 +241,12 @@ def apply_get_controls(inp, restrictions=[0.1,0.5,1,5,10,20], func=get_controls)
 		the radii within which to look for controls
 	func : func 
 		function to apply
+	max_pairs : int
+		maximum number of candidate controls within the largest radius to hold in memory at once
 	'''
 
+	start = time.perf_counter()
 	df = inp[0]
-	sale_controls = inp[1]
-	purchase_controls = inp[2]
 	new_cols = inp[3]
 	price_var = inp[4]
 	pduration_var = inp[5]
@@ -97,10 +255,80 @@ def apply_get_controls(inp, restrictions=[0.1,0.5,1,5,10,20], func=get_controls)
 	restrict_month = inp[8]
 	restrict_both_years = inp[9]
 	margin = inp[10]
-
-	df[new_cols] = df.progress_apply(lambda row: func(row, purchase_controls=purchase_controls, sale_controls=sale_controls, restrictions=restrictions, margin=margin, price_var=price_var, pduration_var=pduration_var, sduration_var=sduration_var, restrict_quarter=restrict_quarter, restrict_month=restrict_month), axis=1, result_type="expand")
+	variants = inp[11]
+	cache_folder = inp[12]
+	trace = inp[13]
+	profile = inp[14]
+	stages = {"pools": 0, "distance": 0, "restriction": 0, "aggregation": 0} if profile is not None else None
+
+	# Count how often the pools were already attached in this worker, from the pool cache of get_shared_control_pool
+	pool_cache = get_shared_control_pool.cache_info()
+	with profile_stage(stages, "pools"):
+		sale_controls = as_control_pool(inp[1])
+		purchase_controls = as_control_pool(inp[2])
+	pool_cache = {"pool_hits": get_shared_control_pool.cache_info().hits - pool_cache.hits, "pool_misses": get_shared_control_pool.cache_info().misses - pool_cache.misses}
+
+	# Compute distances for slices of the block at once, sharing them between the purchase and sale pools if possible. 
+	# The slices hold at most max_pairs candidate controls, so that the neighbours of a dense block do not all need to be held in memory at once
+	restrictions.sort(reverse=True)
+	with profile_stage(stages, "distance"):
+		shared = same_locations(purchase_controls["data"], sale_controls["data"])
+		slices = get_neighbour_slices(df, [purchase_controls] if shared else [purchase_controls, sale_controls], restrictions[0], max_pairs=max_pairs)
+
+	results = []
+	n_candidates = {"purchase": 0, "sale": 0}
+	for slice_start, slice_end in slices:
+		rows = df.iloc[slice_start:slice_end]
+		with profile_stage(stages, "distance"):
+			purchase_neighbours = get_cached_block_neighbours(rows, purchase_controls, restrictions[0], cache_folder=cache_folder)
+			sale_neighbours = purchase_neighbours if shared else get_cached_block_neighbours(rows, sale_controls, restrictions[0], cache_folder=cache_folder)
+			purchase_neighbours = dict(zip(rows.index, purchase_neighbours))
+			sale_neighbours = dict(zip(rows.index, sale_neighbours))
+		n_candidates["purchase"] += sum(len(positions) for positions, _ in purchase_neighbours.values())
+		n_candidates["sale"] += sum(len(positions) for positions, _ in sale_neighbours.values())
+
+		results.append(rows.progress_apply(lambda row: func(row, purchase_controls=purchase_controls, sale_controls=sale_controls, restrictions=restrictions, margin=margin, price_var=price_var, pduration_var=pduration_var, sduration_var=sduration_var, restrict_quarter=restrict_quarter, restrict_month=restrict_month, purchase_neighbours=purchase_neighbours[row.name], sale_neighbours=sale_neighbours[row.name], variants=variants, trace=trace, profile=stages), axis=1, result_type="expand"))
+		del purchase_neighbours, sale_neighbours
+	df[new_cols] = pd.concat(results) if len(results) > 1 else results[0]
+
+	if profile is not None:
+		write_trace(profile, get_profile_record(df, purchase_controls, sale_controls, n_candidates, pool_cache, stages, time.perf_counter() - start))
 	return df
 
+def get_profile_record(df, purchase_pool, sale_pool, n_candidates, pool_cache, stages, seconds):
+	'''
+	get a profile record of the control search for one chunk: its group, the worker that ran it, the number of extensions, the sizes of its control pools, 
+	the number of candidate controls within the largest radius, how many of its pools were found in the pool cache of the worker, and the seconds spent in each stage
+
+	df : DataFrame
+		data for treated properties in the chunk
+	purchase_pool : dict
+		control pool for purchase controls, from index_control_pool
+	sale_pool : dict
+		control pool for sale controls, from index_control_pool
+	n_candidates : dict
+		number of purchase and sale controls within the largest radius, over all treated properties
+	pool_cache : dict
+		number of pools found in (pool_hits) and missing from (pool_misses) the pool cache of get_shared_control_pool
+	stages : dict
+		seconds spent in each stage of the search
+	seconds : float
+		total seconds spent on the chunk
+	'''
+	# Chunks are split by year, purchase year and area (or tile) when parallelized, otherwise they hold several groups
+	partition_var = "tile" if "tile" in df.columns else "area"
+	group = df[["year", "L_year", partition_var]].drop_duplicates()
+	group = group.iloc[0].tolist() if len(group) == 1 else [None, None, None]
+
+	record = {"year": group[0], "L_year": group[1], "partition": group[2], "worker": os.getpid(), "n_extensions": len(df), "n_purchase_pool": len(purchase_pool["data"]), "n_sale_pool": len(sale_pool["data"])}
+	record["n_purchase_candidates"] = n_candidates["purchase"]
+	record["n_sale_candidates"] = n_candidates["sale"]
+	record.update(pool_cache)
+	record["seconds"] = seconds
+	record.update(stages)
+	record["other"] = seconds - sum(stages.values())
+	return record
+
 def get_nearest_controls(df, restrictions=[0.1,0.5,1,5,10,20], tag="", verbose=False):
 	'''
 	for each property, identify the control for the closest radius
@@ -163,28 +391,45 @@ if __name__ == "__main__":
 	file = os.path.join(input_folder, 'for_controls.csv')
 	df = pd.read_csv(file)
 
+	# Compute the controls for every price variable, and for the quarterly variant, from a single search
 	tags = ["_bedrooms","_all", "_linear"]
-	price_vars=['log_price'] + [f'pres{tag}' for tag in tags]
-	for i, tag in enumerate([""]+tags):
+	variants = [{"tag": "", "price_var": "log_price"}] + [{"tag": tag, "price_var": f"pres{tag}"} for tag in tags] + [{"tag": "_quarterly", "price_var": "log_price", "restrict_quarter": True}]
+	outfiles = {variant["tag"]: f"controls{variant['tag']}.csv" for variant in variants}
+
+	# Save the matched control properties from the same search. They match on the exact duration (a margin of 0), which deliberately keeps control_properties.csv as the former GetControlProperties.py 
+	# produced it: that script took its margin from the restrict_both_years input (always False) rather than from margin.
+	# Stream them to disk as they are found, since there can be many controls per extension
+	save_control_properties = True
+	matches_files = None
+	if save_control_properties:
+		variants.append({"tag": "_properties", "price_var": "log_price", "matches": True, "margin": 0})
+		outfiles["_properties"] = "control_properties.csv"
+		matches_files = {"_properties": os.path.join(output_folder, "control_properties.csv.new")}
+
+	# Only compute the extensions that are new or changed since the last run (e.g. after a monthly data refresh)
+	manifest_file = os.path.join(output_folder, "controls_manifest.csv")
+	check_manifest(manifest_file, [os.path.join(output_folder, outfile) for outfile in outfiles.values()])
+	# To audit the search, trace some extensions (e.g. {"file": os.path.join(output_folder, "controls_trace.jsonl"), "sample": 0.001}), only those computed in this run are traced
+	trace = None
+	# To find where the search spends its time, profile it (e.g. os.path.join(output_folder, "controls_profile.json"))
+	profile = None
+	extensions_by_tag = wrapper(df, variants=variants, func=apply_get_controls, cache_folder=os.path.join(output_folder, "neighbour_cache"), manifest_file=manifest_file, matches_files=matches_files, trace=trace, profile=profile)
+
+	for tag, extensions in extensions_by_tag.items():
 		print("Tag:",tag.replace("_", ""))
 		print("----------------")
-		extensions = wrapper(df, price_var=price_vars[i], func=apply_get_controls, restrict_quarter=False)
 
 		# Get nearest controls for each extension 
 		extensions = get_nearest_controls(extensions, tag=tag)
 
 		# Save
-		outfile=f"controls{tag}.csv"
-		extensions.to_csv(os.path.join(output_folder, outfile), index=False)
+		outfile=outfiles[tag]
+		update_output(os.path.join(output_folder, outfile), extensions, manifest_file=manifest_file)
 		print(f"Saved to {outfile}:")
 
-	# Control quarter 
-	print('Control Quarter:')
-	extensions = wrapper(df, price_var='log_price', func=apply_get_controls, restrict_quarter=True)
-	extensions = get_nearest_controls(extensions, tag='_quarterly')
-
-	outfile=f"controls_quarterly.csv"
-	extensions.to_csv(os.path.join(output_folder, outfile), index=False)
-	print(f"Saved to {outfile}:")
+	if save_control_properties:
+		update_output(os.path.join(output_folder, outfiles["_properties"]), matches_files["_properties"], manifest_file=manifest_file)
+		print(f"Saved to {outfiles['_properties']}:")
+	commit_manifest(manifest_file)
 
 	########################################################################
@@ -1,64 +1,226 @@
 from fuzzy_merge import *
 from utils import *
 
+def get_postcode_areas(postcodes):
+	'''
+	gets the postcode area of each postcode (its leading letters, e.g. "SW" for "SW1A 1AA"), or "none" if it is missing
+
+	postcodes : Series
+		postcodes
+	'''
+	return postcodes.astype(str).str.extract(r"^([A-Z]+)", expand=False).fillna("none")
+
+def partition_data(file, folder, name, chunksize=1000000):
+	'''
+	streams a csv file in chunks and writes its rows to one csv file per postcode area, so that the data is never held in memory all at once.
+	returns the postcode areas in the data
+
+	file : string
+		csv file to partition
+	folder : string
+		folder in which to write the partitions
+	name : string
+		prefix of the partition files
+	chunksize : int
+		number of rows to read at once
+	'''
+	areas = set()
+	for chunk in pd.read_csv(file, dtype=str, chunksize=chunksize):
+		for area, group in chunk.groupby(get_postcode_areas(chunk["postcode"])):
+			group.to_csv(os.path.join(folder, f"{name}_{area}.csv"), mode="a", header=area not in areas, index=False)
+			areas.add(area)
+	return areas
+
+def merge_partitions(transaction_file, lease_file, folder, chunksize=1000000, **kwargs):
+	'''
+	fuzzy merge of the transaction and lease data one postcode area at a time, reading only one area of each data set into memory at once.
+	the merge keys and address tokens all include the postcode, so properties can only match within a postcode area
+
+	transaction_file : string
+		csv file with transaction data
+	lease_file : string
+		csv file with lease data
+	folder : string
+		folder in which to write the partitions (deleted at the end)
+	chunksize : int
+		number of rows to read at once when partitioning
+	kwargs :
+		arguments for fuzzy_merge
+	'''
+	if os.path.exists(folder):
+		shutil.rmtree(folder)
+	os.makedirs(folder)
+
+	print("Partitioning price data")
+	transaction_areas = partition_data(transaction_file, folder, "price", chunksize=chunksize)
+	print("Partitioning lease data")
+	lease_areas = partition_data(lease_file, folder, "lease", chunksize=chunksize)
+
+	matches = []
+	for area in sorted(transaction_areas & lease_areas):
+		transaction_data = pd.read_csv(os.path.join(folder, f"price_{area}.csv"), dtype=str)
+		lease_data = pd.read_csv(os.path.join(folder, f"lease_{area}.csv"), dtype=str)
+		print(f"\n\nPostcode area {area}: {len(transaction_data.index)} transactions, {len(lease_data.index)} leases")
+		match, _, _ = fuzzy_merge(transaction_data, lease_data, **kwargs)
+		matches.append(match)
+
+	shutil.rmtree(folder)
+	# There are no matches if no postcode area is in both data sets
+	return pd.concat(matches) if matches else pd.DataFrame(columns=kwargs["output_vars"] + ["common_words"])
+
+def get_block_signatures(transaction_data, lease_data, params=[]):
+	'''
+	get a signature for each postcode, which changes whenever any of its transactions or leases, or the parameters of the merge, change (whatever the order of the rows)
+
+	transaction_data : DataFrame
+		transaction data
+	lease_data : DataFrame
+		lease data
+	params : list
+		parameters of the merge
+	'''
+	# Sum the row hashes of each data set within each postcode (wrapping around), which does not depend on the order of the rows
+	sums = []
+	for data in [transaction_data, lease_data]:
+		row_hashes = pd.util.hash_pandas_object(data[sorted(data.columns)], index=False).values
+		sums.append(pd.DataFrame({"block": get_blocks(data["postcode"]).values, "hash": row_hashes}).groupby("block")["hash"].agg(["sum", "size"]).astype(np.uint64))
+
+	# Postcodes missing from one data set count as empty there. Fill them in as uint64, since going through NaN would round the sums to float64 and lose hash bits
+	blocks = sums[0].index.union(sums[1].index)
+	sums = [data_sums.reindex(blocks, fill_value=0) for data_sums in sums]
+
+	signatures = [hashlib.sha1(f"{row}|{params}".encode()).hexdigest() for row in zip(*[data_sums[col].tolist() for data_sums in sums for col in ["sum", "size"]])]
+	return pd.DataFrame({"block": blocks, "signature": signatures})
+
+def merge_incrementally(transaction_data, lease_data, matches_file, manifest_file, **kwargs):
+	'''
+	fuzzy merge of the transaction and lease data, merging again only the postcodes whose transactions or leases changed since the last run (e.g. after a monthly data refresh).
+	the matches in the other postcodes are reused from the last run, so this relies on the merge keys and address tokens all including the postcode, as in merge_partitions.
+	returns the matches before dropping duplicates, which are also saved to matches_file for the next run
+
+	transaction_data : DataFrame
+		transaction data
+	lease_data : DataFrame
+		lease data
+	matches_file : string
+		csv file with the matches of the last run
+	manifest_file : string
+		csv file with the signature of each postcode in the last run
+	kwargs :
+		arguments for fuzzy_merge
+	'''
+	pid1, pid2 = kwargs["pid1"], kwargs["pid2"]
+	check_manifest(manifest_file, [matches_file])
+	current = get_block_signatures(transaction_data, lease_data, params=sorted(kwargs.items()))
+
+	unchanged = set()
+	if os.path.exists(manifest_file):
+		previous = pd.read_csv(manifest_file, dtype=str, keep_default_na=False)
+		unchanged = set(current.merge(previous, on=["block", "signature"])["block"])
+
+	changed1 = ~get_blocks(transaction_data["postcode"]).isin(unchanged).values
+	changed2 = ~get_blocks(lease_data["postcode"]).isin(unchanged).values
+	print(f"{len(unchanged)} of {len(current.index)} postcodes unchanged since the last run, merging {changed1.sum()} transactions and {changed2.sum()} leases")
+
+	matches = []
+	if len(unchanged) > 0:
+		match = pd.read_csv(matches_file, dtype={pid1: str, pid2: str, "merged_on": str})
+		match = match.loc[match[pid1].isin(transaction_data.loc[~changed1, pid1].astype(str)) & match[pid2].isin(lease_data.loc[~changed2, pid2].astype(str))]
+		print(f"Reusing {len(match.index)} matches")
+		matches.append(match)
+	if changed1.any() and changed2.any():
+		match, _, _ = fuzzy_merge(transaction_data.loc[changed1].copy(), lease_data.loc[changed2].copy(), **kwargs)
+		matches.append(match)
+	match = pd.concat(matches) if matches else pd.DataFrame(columns=kwargs["output_vars"] + ["common_words"])
+
+	# Save the matches and the signatures for the next run, recording the signatures last so that an interrupted run is merged again
+	current.to_csv(f"{manifest_file}.pending", index=False)
+	match.to_csv(f"{matches_file}.new", index=False)
+	os.replace(f"{matches_file}.new", matches_file)
+	commit_manifest(manifest_file)
+	return match
+
+def drop_duplicate_matches(match, pid1, pid2):
+	'''
+	drops duplicate matches: for each property in either data set, keep the matches with the most words in common and, if there are still several, those with the same start.
+	properties that still have several matches are dropped
+
+	match : DataFrame
+		matches from fuzzy_merge
+	pid1 : string
+		unique identifier key for the first data set
+	pid2 : string
+		unique identifier key for the second data set
+	'''
+	match = match.drop_duplicates(keep="first")
+
+	# Whether both properties start with the same two words (the same whichever of them is duplicated)
+	same_start = (match[pid1].str.split().str[:2].str.join(' ') == match[pid2].str.split().str[:2].str.join(' ')).values
+
+	for pid in [pid1, pid2]:
+		# Group the matches by property, and count or compare them within each group with numpy
+		groups, properties = pd.factorize(match[pid], use_na_sentinel=False)
+		common_words = match["common_words"].values.astype(np.int64)
+
+		# Keep the matches with the most words in common
+		max_common_words = np.full(len(properties), np.iinfo(np.int64).min)
+		np.maximum.at(max_common_words, groups, common_words)
+		keep = common_words == max_common_words[groups]
+
+		# If there are still duplicates, keep those with the same start
+		n_matches = np.bincount(groups[keep], minlength=len(properties))
+		match['dup'] = n_matches[groups] > 1
+		match['max_common_words'] = max_common_words[groups]
+		keep &= (n_matches[groups] == 1) | same_start
+
+		# Drop the remaining duplicates
+		keep &= np.bincount(groups[keep], minlength=len(properties))[groups] == 1
+		match = match[keep]
+		same_start = same_start[keep]
+	return match
+
 if __name__ == "__main__":
 	'''
-	Fuzzy merge of HMLR data 
+	Fuzzy merge of HMLR data
 	'''
 
-	# HMLR merge
-	print("Importing price data")
 	transaction_file = os.path.join(working_folder, "price_data_for_merge.csv")
-	transaction_data = pd.read_csv(transaction_file)
-	print("Number of rows:", len(transaction_data.index))
-
-	print("\nImporting lease data")
 	lease_file = os.path.join(working_folder, "lease_data_for_merge.csv")
-	lease_data = pd.read_csv(lease_file)
-	print("Number of rows:", len(lease_data.index))
-
 	pid1 = 'property_id'
 	pid2 = 'merge_key'
 	output_file = os.path.join(working_folder, "hmlr_merge_keys.dta")
-	match, _, _ = fuzzy_merge(transaction_data, lease_data, pid1=pid1, pid2=pid2, to_tokenize1="address", to_tokenize2="address", exact_ids=["merge_key_1", "merge_key_2"], output_vars=['property_id','merge_key','merged_on'])
+	# To also match the addresses left unmatched on their similarity within each postcode, set a minimum similarity (e.g. 0.8)
+	similarity_threshold = None
+	merge_options = dict(pid1=pid1, pid2=pid2, to_tokenize1="address", to_tokenize2="address", exact_ids=["merge_key_1", "merge_key_2"], output_vars=['property_id','merge_key','merged_on'], similarity_threshold=similarity_threshold)
+
+	# To merge the data on a machine that cannot hold it all in memory, merge one postcode area at a time
+	partitioned = False
+	# Only merge again the postcodes whose transactions or leases changed since the last run, reusing the matches in the others (when not partitioned)
+	incremental = True
+
+	# HMLR merge
+	if partitioned:
+		match = merge_partitions(transaction_file, lease_file, os.path.join(working_folder, "hmlr_merge_partitions"), **merge_options)
+	else:
+		print("Importing price data")
+		transaction_data = pd.read_csv(transaction_file)
+		print("Number of rows:", len(transaction_data.index))
+
+		print("\nImporting lease data")
+		lease_data = pd.read_csv(lease_file)
+		print("Number of rows:", len(lease_data.index))
+
+		if incremental:
+			match = merge_incrementally(transaction_data, lease_data, os.path.join(working_folder, "hmlr_merge_matches.csv"), os.path.join(working_folder, "hmlr_merge_manifest.csv"), **merge_options)
+		else:
+			match, _, _ = fuzzy_merge(transaction_data, lease_data, **merge_options)
 
 	print(match)
 
 	############################
 	# Drop duplicates matches
 	############################
-	len_before = len(match.index)
-	match = match.drop_duplicates(keep="first")
-	# print(f"Dropped {len_before - len(match.index)} entries.")
-	len_before = len(match.index)
+	match = drop_duplicate_matches(match, pid1, pid2)
 
-	for pid in [pid1, pid2]:
-		# print()
-		# print(pid)
-		# print('--------')
-		if pid == pid1:
-			other_pid = pid2
-		else:
-			other_pid = pid1
-			
-		match['dup'] = match[pid].duplicated(keep=False)
-		match['max_common_words'] = match.groupby(pid)['common_words'].transform('max')
-		match = match[match.common_words==match.max_common_words]
-		
-		# print(f"Dropped {len_before - len(match.index)} entries by using common words.")
-		len_before = len(match.index)
-
-		i = 2
-		match['dup'] = match[pid].duplicated(keep=False)
-		match = match[(match.dup==False)|(match[pid].str.split().str[:i].apply(' '.join)==match[other_pid].str.split().str[:i].apply(' '.join))]
-
-		# print(f"Dropped {len_before - len(match.index)} entries by using start of the sentence.")
-		len_before = len(match.index)
-			
-		match = match.drop_duplicates(subset=[pid], keep=False)
-		
-		# print(f"Dropped {len_before - len(match.index)} remaining duplicates of {pid}.")
-		len_before = len(match.index)
-
-	# Export 
-	match.to_stata(output_file, write_index=False)
\ No newline at end of file
+	# Export
+	match.to_stata(output_file, write_index=False)
@@ -2,23 +2,54 @@ from fuzzy_merge import *
 from utils import *
 import numpy as np
 
-def merge_rightmove():
+def load_hmlr_data():
 	'''
-	Fuzzy merge of HMLR data and Rightmove data 
+	loads the HMLR data and tokenizes its addresses, once for all the portals it is merged with.
+	returns the data and its tokens (see tokenize_all)
 	'''
-
-	# Rightmove merge
 	print("Importing HMLR data")
 	hmlr_file = os.path.join(working_folder, f"hmlr_for_hedonics_merge.dta")
 	hmlr_data = pd.read_stata(hmlr_file)
 	print("Number of rows:", len(hmlr_data.index))
 
-	print("\nImporting Rightmove data")
+	print("Tokenizing HMLR addresses")
+	tokens = tokenize_all(hmlr_data["address"], hmlr_data["postcode"])
+	return hmlr_data, tokens
+
+def merge_portal(name, file, hmlr=None, **kwargs):
+	'''
+	Fuzzy merge of HMLR data and the data of a property portal
+
+	name : string
+		name of the portal
+	file : string
+		file with the portal data
+	hmlr : tuple (DataFrame, tuple)
+		HMLR data and its tokens, from load_hmlr_data (loaded if None)
+	kwargs :
+		arguments for fuzzy_merge (to_tokenize2, exact_ids, output_vars...)
+	'''
+	hmlr_data, tokens = hmlr if hmlr is not None else load_hmlr_data()
+
+	print(f"\nImporting {name} data")
+	portal_data = pd.read_stata(file)
+	print("Number of rows:", len(portal_data.index))
+
+	# fuzzy_merge adds columns to the data, so give it a (shallow) copy to keep the HMLR data the same for every portal
+	match, _, _ = fuzzy_merge(hmlr_data.copy(deep=False), portal_data, pid1="property_id_x", pid2="property_id_y", to_tokenize1="address", tokens1=tokens, **kwargs)
+	return match
+
+def merge_rightmove(hmlr=None):
+	'''
+	Fuzzy merge of HMLR data and Rightmove data
+
+	hmlr : tuple (DataFrame, tuple)
+		HMLR data and its tokens, from load_hmlr_data (loaded if None)
+	'''
+
+	# Rightmove merge
 	rightmove_file = os.path.join(working_folder, f"rightmove_for_merge_flats.dta")
-	rightmove_data = pd.read_stata(rightmove_file)
-	print("Number of rows:", len(rightmove_data.index))
-	
-	match, _, _ = fuzzy_merge(hmlr_data, rightmove_data, pid1="property_id_x", pid2="property_id_y", to_tokenize1="address", to_tokenize2="address1", exact_ids=["property_id", "uprn"], output_vars=["property_id_x", "property_id_y", "uprn_x", "uprn_y", "merged_on"])
+	match = merge_portal("Rightmove", rightmove_file, hmlr=hmlr, to_tokenize2="address1", exact_ids=["property_id", "uprn"], output_vars=["property_id_x", "property_id_y", "uprn_x", "uprn_y", "merged_on"])
 	match = match[(match.uprn_x==match.uprn_y)|(match.uprn_x.isna())|(match.uprn_y.isna())]
 	match = match.rename(columns={'property_id_x':'property_id', 'property_id_y':'property_id_rm'})
 	match['uprn'] = np.where(match['uprn_x'].notnull(), match['uprn_x'], match['uprn_y'])
@@ -28,23 +59,17 @@ def merge_rightmove():
 	match.to_stata(output_file)
 
 
-def merge_zoopla():
+def merge_zoopla(hmlr=None):
 	'''
-	Fuzzy merge of HMLR data and Zoopla data 
+	Fuzzy merge of HMLR data and Zoopla data
+
+	hmlr : tuple (DataFrame, tuple)
+		HMLR data and its tokens, from load_hmlr_data (loaded if None)
 	'''
 
 	# Zoopla merge
-	print("Importing HMLR data")
-	hmlr_file = os.path.join(working_folder, f"hmlr_for_hedonics_merge.dta")
-	hmlr_data = pd.read_stata(hmlr_file)
-	print("Number of rows:", len(hmlr_data.index))
-
-	print("\nImporting Zoopla data")
 	zoopla_file = os.path.join(working_folder, f"zoopla_for_merge.dta")
-	zoopla_data = pd.read_stata(zoopla_file)
-	print("Number of rows:", len(zoopla_data.index))
-
-	match, _, _ = fuzzy_merge(hmlr_data, zoopla_data, pid1="property_id_x", pid2="property_id_y", to_tokenize1="address", to_tokenize2="property_number", exact_ids=["property_id"], output_vars=["property_id_x", "property_id_y", "merged_on"])
+	match = merge_portal("Zoopla", zoopla_file, hmlr=hmlr, to_tokenize2="property_number", exact_ids=["property_id"], output_vars=["property_id_x", "property_id_y", "merged_on"])
 	match = match.rename(columns={'property_id_x':'property_id', 'property_id_y':'property_id_zoop'})
 	match = match.drop_duplicates(subset=['property_id', 'property_id_zoop'], keep='first')
 	match = match.drop_duplicates(subset=['property_id_zoop'], keep=False)
@@ -54,8 +79,11 @@ def merge_zoopla():
 
 
 if __name__ == "__main__":
+	# Load and tokenize the HMLR data once, for all portals
+	hmlr = load_hmlr_data()
+
 	# Merge rightmove data
-	merge_rightmove()
+	merge_rightmove(hmlr)
 
 	# Merge zoopla data
-	merge_zoopla()
\ No newline at end of file
+	merge_zoopla(hmlr)
@@ -1,9 +1,21 @@
 import os 
+import re
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
+from multiprocessing import Pool
+from scipy import sparse
 tqdm.pandas()
 pd.options.mode.chained_assignment = None
 
+# Key words that are necessary for a match. Single words must appear as words of the address, while longer terms can appear anywhere in it
+necessary_terms = ["ASSOCIATED WITH", "GARAGE", "PARKING", "STORAGE", "LAND", "BALCONY ADJOINING", "GROUND", "GARDEN FLOOR", "LOWER", "FIRST", "SECOND", "THIRD", "FOURTH", "FLOOR", "BASEMENT"] + [f"LAND LYING TO THE {direction} OF" for direction in ["NORTH","SOUTH","EAST","WEST"]]
+single_word_terms = {term for term in necessary_terms if len(term.split())==1}
+multi_word_terms = re.compile("(?=(" + "|".join(re.escape(term) for term in necessary_terms if len(term.split())>1) + "))")
+
+# Single letters are necessary as well (e.g. flat A)
+letters = set('abcdefghijklmnopqrstuvwxy'.upper())
+
 def clean_number(s):
 	'''
 	removes filler words from an address number
@@ -36,6 +48,19 @@ def get_common_words(s1, s2):
 		return 0
 	return len(list(set(s1.split(" ")) & set(s2.split(" "))))
 
+def count_common_words(strings1, strings2):
+	'''
+	returns the number of words that each pair of strings have in common, as get_common_words, splitting each distinct string only once
+
+	strings1 : Series
+		first string of each pair
+	strings2 : Series
+		second string of each pair
+	'''
+	words = {s: set(s.split(" ")) for s in pd.unique(pd.concat([strings1, strings2])) if type(s)==str}
+	empty = set()
+	return np.array([len(words.get(s1, empty) & words.get(s2, empty)) if type(s1)==str and type(s2)==str else 0 for s1, s2 in zip(strings1, strings2)], dtype=np.int64)
+
 def tokenize(s, n):
 	'''
 	tokenizes an address and creates (1) a set of necessary strings and (2) a set of all non-trivial strings
@@ -52,12 +77,11 @@ def tokenize(s, n):
 	necessary = []
 	desired = []
 
-	# There are certain key words that are necessary 
-	for term in ["ASSOCIATED WITH", "GARAGE", "PARKING", "STORAGE", "LAND", "BALCONY ADJOINING", "GROUND", "GARDEN FLOOR", "LOWER", "FIRST", "SECOND", "THIRD", "FOURTH", "FLOOR", "BASEMENT"] + [f"LAND LYING TO THE {direction} OF" for direction in ["NORTH","SOUTH","EAST","WEST"]]:
-		if (len(term.split())==1 and term in s.split()) or (len(term.split())>1 and term in s):
-			necessary.append(term)
+	# There are certain key words that are necessary (all of them are found in a single pass over the address)
+	necessary.extend(single_word_terms.intersection(l))
+	necessary.extend(set(multi_word_terms.findall(s)))
 	for word in l:
-		if (word.isnumeric() or has_numbers(word) or word in list('abcdefghijklmnopqrstuvwxy'.upper())) and word!="0":
+		if (word.isnumeric() or has_numbers(word) or word in letters) and word!="0":
 			necessary.append(word)
 			desired.append(word)
 		else:
@@ -68,79 +92,353 @@ def tokenize(s, n):
 	desired.append(n)
 	return [tuple(sorted(necessary)), tuple(sorted(desired))]
 
-def fuzzy_merge(data1, data2, pid1="", pid2="", to_tokenize1="", to_tokenize2="", exact_ids=["property_id", "uprn"], output_vars=[]):
+def tokenize_pairs(pairs):
 	'''
-	conducts a fuzzy merge of two data sets.
+	tokenizes a list of (address, necessary string) pairs with tokenize
 
-	data1 : DataFrame
-		first data set on which to conduct fuzzy merge 
-	data2 : DataFrame
-		second data set on which to conduct fuzzy merge
+	pairs : list (tuple)
+		address and necessary string of each pair
+	'''
+	return [tokenize(s, n) for s, n in pairs]
+
+def tokenize_all(addresses, postcodes, num_processes=None, chunk_size=100000):
+	'''
+	tokenizes every address in a data set as tokenize does, but only once for each distinct (address, postcode) pair, since addresses repeat across transactions.
+	if there are many distinct pairs, they are tokenized in parallel chunks. returns the necessary and desired tokens of each row, as arrays of tuples
+
+	addresses : Series
+		address strings to tokenize
+	postcodes : Series
+		necessary strings which must be identified in match (e.g. postcode)
+	num_processes : int
+		number of processes to use if there is more than one chunk (all cores if None)
+	chunk_size : int
+		number of distinct pairs per chunk
+	'''
+	# tokenize converts its inputs to strings, so pairs are distinct if their strings are
+	codes, pairs = pd.MultiIndex.from_arrays([addresses.map(str), postcodes.map(str)]).factorize()
+	pairs = list(pairs)
+	chunks = [pairs[i:i+chunk_size] for i in range(0, len(pairs), chunk_size)]
+
+	num_processes = int(num_processes if num_processes is not None else os.cpu_count())
+	if len(chunks) > 1 and num_processes > 1:
+		with Pool(min(num_processes, len(chunks))) as pool:
+			tokens = [token for chunk in tqdm(pool.imap(tokenize_pairs, chunks), total=len(chunks)) for token in chunk]
+	else:
+		tokens = [token for chunk in tqdm(chunks) for token in tokenize_pairs(chunk)]
+
+	necessary = np.empty(len(tokens), dtype=object)
+	desired = np.empty(len(tokens), dtype=object)
+	necessary[:] = [token[0] for token in tokens]
+	desired[:] = [token[1] for token in tokens]
+	return necessary[codes], desired[codes]
+
+def intern_tokens(*tokens):
+	'''
+	gives each distinct set of tokens an integer ID, shared by all arrays of tokens.
+	returns the IDs for each array of tokens, followed by the set of tokens for each ID
+
+	tokens : array (tuple)
+		arrays of tokens from tokenize_all
+	'''
+	ids, vocabulary = pd.factorize(np.concatenate(tokens))
+	return np.split(ids, np.cumsum([len(array) for array in tokens])[:-1]) + [vocabulary]
+
+def restore_tokens(data, vocabulary):
+	'''
+	replaces the token IDs from intern_tokens in a data set (including variables suffixed by a merge) by the tokens themselves
+
+	data : DataFrame
+		data set with token IDs
+	vocabulary : array (tuple)
+		set of tokens for each ID, from intern_tokens
+	'''
+	for col in data.columns:
+		if col in [f"{key}{suffix}" for key in ["necessary", "desired"] for suffix in ["", "_x", "_y"]]:
+			data[col] = vocabulary[data[col].values.astype(np.int64)]
+
+def get_output_columns(data, merge_key, output_vars):
+	'''
+	gets the variables of a data set needed to output its matches: the merge key, and the variables in the output (with or without the suffix the merge adds)
+
+	data : DataFrame
+		data set to merge
+	merge_key : string
+		key on which to merge
+	output_vars : list(string)
+		keys to output after merge
+	'''
+	return [col for col in data.columns if col==merge_key or col in output_vars or f"{col}_x" in output_vars or f"{col}_y" in output_vars]
+
+def merge_on_keys(unmatched1, unmatched2, merge_keys, pid1="", pid2="", exact_ids=["property_id", "uprn"], output_vars=[], verbose=True):
+	'''
+	merges two data sets on each key in turn, so that only the data left unmatched by one key is merged on the next one.
+	only the matched pairs are joined: the unmatched data is found by dropping the properties whose key is in the other data set.
+	returns the matches on each key (by key) and the data left unmatched in each data set
+
+	unmatched1 : DataFrame
+		first data set to merge
+	unmatched2 : DataFrame
+		second data set to merge
+	merge_keys : list (string)
+		keys on which to merge, in order
 	pid1 : string
 		unique identifier key for data1 
 	pid2: string
 		unique identifier key for data2 
-	to_tokenize1 : string
-		key for data1 which contains the full property address for the merge 
-	to_tokenize2 : string
-		key for data2 which contains the full property address for the merge 
 	exact_ids : list (string)
 		keys in data1 and data2 on which to conduct a perfect merge
 	output_vars : list(string)
 		keys to output after merge
+	verbose : bool
+		flag for whether to print output
 	'''
 
-	# Create columns with necessary and desired fields
-	data1[["necessary", "desired"]] = data1.progress_apply(lambda row: tokenize(row[to_tokenize1], row["postcode"]), axis=1, result_type="expand")
-	data2[["necessary", "desired"]] = data2.progress_apply(lambda row: tokenize(row[to_tokenize2], row["postcode"]), axis=1, result_type="expand")
+	# Create dictionary in which to store matches
+	matches = {}
 
-	# List of variables
-	keys = ["postcode", "necessary", "desired"] + exact_ids
+	for merge_key in merge_keys:
+		if verbose:
+			print(f"\nMerging on {merge_key}:")
 
-	# Create DF in which to store matches
-	matches = []
-	unmatched1 = data1 
-	unmatched2 = data2
+		# Properties with a key that is in the other data set (missing keys in data1 are never merged)
+		matched1 = unmatched1[merge_key].notna() & unmatched1[merge_key].isin(unmatched2[merge_key])
+		matched2 = unmatched2[merge_key].isin(unmatched1.loc[matched1, merge_key])
 
-	# First, merge on exact IDs
-	for merge_key in exact_ids + ["desired","necessary"]:
-		print(f"\nMerging on {merge_key}:")
-		total_merge = unmatched1[~unmatched1[merge_key].isna()].merge(unmatched2, left_on=merge_key, right_on=merge_key, how='outer', indicator=True)
-
-		match = total_merge[total_merge['_merge']=='both']
+		# Join the matched properties, keeping only the variables needed for the output (with the same suffixes as if all variables were kept)
+		match = unmatched1.loc[matched1, get_output_columns(unmatched1, merge_key, output_vars)].merge(unmatched2.loc[matched2, get_output_columns(unmatched2, merge_key, output_vars)], on=merge_key, how='inner')
 		match[f"{merge_key}_x"] = match[merge_key].copy()
 		match[f"{merge_key}_y"] = match[merge_key].copy()
 		match["merged_on"] = merge_key
-		print("Num Matched:", len(match.index))
+		if verbose:
+			print("Num Matched:", len(match.index))
 
 		# print(f"\n\nData matched on {merge_key}:")
 		# print(match)
 		# print(list(match.columns))
 
 		if len(match.index)==0:
-			print("No match")
+			if verbose:
+				print("No match")
 			continue
 
 		# Add matches to data frame
-		matches.append(match[output_vars])
+		matches[merge_key] = match[output_vars]
 
-		# Keys to keep 
-		lhs_keys = [f"{key}_x" for key in keys if key!=merge_key] + [merge_key]
-		if pid1 not in lhs_keys and pid1.replace("_x","")!=merge_key:
-			lhs_keys.append(pid1)
+		# Keep track of unmatched data for future merges
+		unmatched1 = unmatched1.loc[~matched1]
+		unmatched2 = unmatched2.loc[~matched2]
 
-		rhs_keys = [f"{key}_y" for key in keys if key!=merge_key] + [merge_key]
-		if pid2 not in rhs_keys and pid2.replace("_y","")!=merge_key:
-			rhs_keys.append(pid2)
+	return matches, unmatched1, unmatched2
 
-		# Keep track of unmatched data for future merges
-		unmatched1_new = total_merge[total_merge['_merge']=='left_only'][lhs_keys].rename(columns={f"{key}_x":key for key in keys})
-		unmatched1 = pd.concat([unmatched1_new, unmatched1[unmatched1[merge_key].isna()]])
-		# print("Unmatched (all))", len(unmatched1.index))
+def get_ngram_vectors(strings, blocks, n=3):
+	'''
+	gets TF-IDF vectors of the character n-grams of some strings, as the rows of a sparse matrix with unit length.
+	each n-gram is a separate feature in each block, so that the vectors of strings in different blocks are orthogonal, and n-grams are weighted by how rare they are within the block
+
+	strings : list (string)
+		strings to vectorize
+	blocks : array (int)
+		block of each string
+	n : int
+		number of characters per n-gram
+	'''
+	features = {}
+	rows, cols = [], []
+	for i, (s, block) in enumerate(zip(strings, blocks)):
+		s = f" {s} "
+		for j in range(max(len(s) - n + 1, 1)):
+			rows.append(i)
+			cols.append(features.setdefault((block, s[j:j+n]), len(features)))
+	counts = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(strings), len(features)))
+	counts.sum_duplicates()
+
+	# Smoothed inverse document frequency, within the block of each feature
+	block_sizes = np.bincount(blocks, minlength=blocks.max() + 1 if len(blocks) > 0 else 0)
+	feature_blocks = np.array([block for block, _ in features], dtype=np.int64)
+	document_frequency = np.bincount(counts.indices, minlength=len(features))
+	idf = np.log((1 + block_sizes[feature_blocks]) / (1 + document_frequency)) + 1
+
+	vectors = counts.multiply(idf[None, :]).tocsr()
+	norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+	return sparse.diags(1 / np.where(norms > 0, norms, 1)) @ vectors
+
+def merge_on_similarity(unmatched1, unmatched2, to_tokenize1="", to_tokenize2="", output_vars=[], threshold=0.8, top_k=1):
+	'''
+	merges two data sets on the similarity of their addresses within each postcode: the cosine similarity of the TF-IDF vectors of their character trigrams.
+	each property in unmatched1 is matched to the (up to) top_k most similar properties in unmatched2 with the same postcode, if their similarity is at least threshold.
+	returns the matches (with their similarity) and the data left unmatched in each data set
+
+	unmatched1 : DataFrame
+		first data set to merge
+	unmatched2 : DataFrame
+		second data set to merge
+	to_tokenize1 : string
+		key for data1 which contains the full property address for the merge 
+	to_tokenize2 : string
+		key for data2 which contains the full property address for the merge 
+	output_vars : list(string)
+		keys to output after merge
+	threshold : float
+		minimum similarity for a match
+	top_k : int
+		maximum number of matches for each property in unmatched1
+	'''
+	blocks = pd.factorize(pd.concat([get_blocks(unmatched1["postcode"]), get_blocks(unmatched2["postcode"])]))[0]
+	strings = [clean_number(str(s)) for s in unmatched1[to_tokenize1]] + [clean_number(str(s)) for s in unmatched2[to_tokenize2]]
+	vectors = get_ngram_vectors(strings, blocks)
+
+	# Only properties in the same postcode share features, so the product only holds pairs within a postcode
+	similarity = (vectors[:len(unmatched1.index)] @ vectors[len(unmatched1.index):].T).tocoo()
+	rows, cols, scores = similarity.row, similarity.col, similarity.data
+	is_similar = scores >= threshold - 1e-9
+	rows, cols, scores = rows[is_similar], cols[is_similar], scores[is_similar]
+
+	# Keep the top_k most similar properties for each property (the first ones in the data in case of ties)
+	order = np.lexsort((cols, -scores, rows))
+	rows, cols, scores = rows[order], cols[order], scores[order]
+	rank = np.arange(len(rows)) - np.searchsorted(rows, rows, side="left")
+	rows, cols, scores = rows[rank < top_k], cols[rank < top_k], scores[rank < top_k]
+
+	match1 = unmatched1.iloc[rows][get_output_columns(unmatched1, "", output_vars)].assign(pair=np.arange(len(rows)))
+	match2 = unmatched2.iloc[cols][get_output_columns(unmatched2, "", output_vars)].assign(pair=np.arange(len(rows)))
+	match = match1.merge(match2, on="pair").drop(columns="pair")
+	match["merged_on"] = "similarity"
+	match["similarity"] = scores
+
+	matched1 = np.zeros(len(unmatched1.index), dtype=bool)
+	matched1[rows] = True
+	matched2 = np.zeros(len(unmatched2.index), dtype=bool)
+	matched2[cols] = True
+	return match, unmatched1.loc[~matched1], unmatched2.loc[~matched2]
+
+def merge_chunk(inp):
+	'''
+	wrapper for merge_on_keys (and merge_on_similarity), to merge a chunk of blocks in a pool of workers
+
+	inp : tuple
+		the chunk of each data set, followed by the other arguments of merge_on_keys and the arguments of merge_on_similarity (or None)
+	'''
+	matches, unmatched1, unmatched2 = merge_on_keys(*inp[:7], verbose=False)
+	similarity = inp[7]
+	if similarity is not None:
+		match, unmatched1, unmatched2 = merge_on_similarity(unmatched1, unmatched2, output_vars=inp[6], **similarity)
+		if len(match.index) > 0:
+			matches["similarity"] = match[inp[6] + ["similarity"]]
+	return matches, unmatched1, unmatched2
+
+def get_blocks(postcodes, block="postcode"):
+	'''
+	gets the block of each property for a blocked merge: its postcode (as a string, as in tokenize), or its postcode sector (the postcode without its last two letters)
+
+	postcodes : Series
+		postcodes of the properties
+	block : string
+		"postcode" or "sector"
+	'''
+	postcodes = postcodes.map(str)
+	if block == "sector":
+		return postcodes.str[:-2].str.strip()
+	return postcodes
+
+def split_into_blocks(data1, data2, block="postcode", chunk_size=100000):
+	'''
+	splits two data sets into chunks of whole blocks (see get_blocks), with about chunk_size properties (from both data sets) per chunk.
+	returns a list with the part of each data set in each chunk
+
+	data1 : DataFrame
+		first data set
+	data2 : DataFrame
+		second data set
+	block : string
+		"postcode" or "sector"
+	chunk_size : int
+		number of properties per chunk
+	'''
+	blocks1 = get_blocks(data1["postcode"], block)
+	blocks2 = get_blocks(data2["postcode"], block)
+
+	# Go through the blocks in order, starting a new chunk whenever the current one is full
+	sizes = pd.concat([blocks1, blocks2]).value_counts().sort_index()
+	chunk_of_block = pd.Series(((sizes.cumsum() - sizes) // chunk_size).values, index=sizes.index)
+	chunks1 = dict(list(data1.groupby(blocks1.map(chunk_of_block).values)))
+	chunks2 = dict(list(data2.groupby(blocks2.map(chunk_of_block).values)))
+	return [(chunks1.get(chunk, data1.iloc[:0]), chunks2.get(chunk, data2.iloc[:0])) for chunk in sorted(chunk_of_block.unique())]
+
+def fuzzy_merge(data1, data2, pid1="", pid2="", to_tokenize1="", to_tokenize2="", exact_ids=["property_id", "uprn"], output_vars=[], block="postcode", chunk_size=100000, similarity_threshold=None, similarity_top_k=1, num_processes=None, tokens1=None):
+	'''
+	conducts a fuzzy merge of two data sets.
 
-		unmatched2 = total_merge[total_merge['_merge']=='right_only'][rhs_keys].rename(columns={f"{key}_y":key for key in keys})
+	data1 : DataFrame
+		first data set on which to conduct fuzzy merge 
+	data2 : DataFrame
+		second data set on which to conduct fuzzy merge
+	pid1 : string
+		unique identifier key for data1 
+	pid2: string
+		unique identifier key for data2 
+	to_tokenize1 : string
+		key for data1 which contains the full property address for the merge 
+	to_tokenize2 : string
+		key for data2 which contains the full property address for the merge 
+	exact_ids : list (string)
+		keys in data1 and data2 on which to conduct a perfect merge
+	output_vars : list(string)
+		keys to output after merge
+	block : string
+		blocks in which to merge on the address tokens: "postcode" or "sector" (see get_blocks)
+	chunk_size : int
+		number of properties per chunk of blocks, for tokenizing and for merging on the address tokens
+	similarity_threshold : float
+		if provided, the properties left unmatched are finally matched on the similarity of their addresses within each postcode, if it is at least this threshold (see merge_on_similarity).
+		these matches have merged_on set to "similarity", and their similarity is output as well
+	similarity_top_k : int
+		maximum number of matches on similarity for each property in data1
+	num_processes : int
+		number of processes to use if there is more than one chunk (all cores if None)
+	tokens1 : tuple (array, array)
+		necessary and desired tokens of data1 from tokenize_all, if already computed (e.g. to merge data1 with several data sets)
+	'''
+
+	# Create columns with necessary and desired fields
+	necessary1, desired1 = tokens1 if tokens1 is not None else tokenize_all(data1[to_tokenize1], data1["postcode"], num_processes=num_processes, chunk_size=chunk_size)
+	necessary2, desired2 = tokenize_all(data2[to_tokenize2], data2["postcode"], num_processes=num_processes, chunk_size=chunk_size)
+
+	# Merge on integer IDs for each set of tokens, which are much faster to hash and compare than tuples of strings (the tokens are put back at the end)
+	data1["necessary"], data1["desired"], data2["necessary"], data2["desired"], vocabulary = intern_tokens(necessary1, desired1, necessary2, desired2)
+
+	# First, merge on exact IDs
+	matches, unmatched1, unmatched2 = merge_on_keys(data1, data2, exact_ids, pid1=pid1, pid2=pid2, exact_ids=exact_ids, output_vars=output_vars)
+
+	# The tokens always include the postcode, so properties can only match on them within a postcode. Merge on them in chunks of whole blocks, in parallel
+	token_keys = ["desired","necessary"]
+	similarity = None
+	if similarity_threshold is not None:
+		similarity = {"to_tokenize1": to_tokenize1, "to_tokenize2": to_tokenize2, "threshold": similarity_threshold, "top_k": similarity_top_k}
+	chunks = [(chunk1, chunk2, token_keys, pid1, pid2, exact_ids, output_vars, similarity) for chunk1, chunk2 in split_into_blocks(unmatched1, unmatched2, block=block, chunk_size=chunk_size)]
+	num_processes = int(num_processes if num_processes is not None else os.cpu_count())
+	if len(chunks) > 1 and num_processes > 1:
+		with Pool(min(num_processes, len(chunks))) as pool:
+			results = list(tqdm(pool.imap(merge_chunk, chunks), total=len(chunks)))
+	else:
+		results = [merge_chunk(chunk) for chunk in tqdm(chunks)]
+
+	for merge_key in token_keys + (["similarity"] if similarity is not None else []):
+		print(f"\nMerging on {merge_key}:")
+		match = [chunk_matches[merge_key] for chunk_matches, _, _ in results if merge_key in chunk_matches]
+		print("Num Matched:", sum(len(chunk_match.index) for chunk_match in match))
+		if len(match)==0:
+			print("No match")
+			continue
+		matches[merge_key] = pd.concat(match)
+	# There are no chunks if every property was matched on the exact IDs
+	unmatched1 = pd.concat([chunk_unmatched1 for _, chunk_unmatched1, _ in results]) if len(results) > 0 else unmatched1.iloc[:0]
+	unmatched2 = pd.concat([chunk_unmatched2 for _, _, chunk_unmatched2 in results]) if len(results) > 0 else unmatched2.iloc[:0]
 
-	matches = pd.concat(matches)
+	# There may be no matches at all (e.g. in a small partition of the data)
+	matches = pd.concat(matches.values()) if len(matches) > 0 else pd.DataFrame(columns=output_vars)
 	# Get number of words in common for merges, in case of duplicates
-	matches["common_words"] = matches.apply(lambda row: get_common_words(row[pid1],row[pid2]), axis=1)
-	return matches[output_vars + ["common_words"]], unmatched1, unmatched2
\ No newline at end of file
+	matches["common_words"] = count_common_words(matches[pid1], matches[pid2])
+	for data in [matches, unmatched1, unmatched2, data1, data2]:
+		restore_tokens(data, vocabulary)
+	return matches.reindex(columns=output_vars + ["common_words"] + (["similarity"] if similarity is not None else [])), unmatched1, unmatched2
\ No newline at end of file
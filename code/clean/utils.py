@@ -1,9 +1,17 @@
 import os 
+import shutil
+import hashlib
+import time
+import json
+import pickle
 import pandas as pd
 from tqdm import tqdm
 import numpy as np
-from multiprocessing import Pool
+from multiprocessing import Pool, shared_memory
+from functools import lru_cache
+from contextlib import contextmanager
 from math import ceil
+from scipy.spatial import cKDTree
 pd.options.mode.chained_assignment = None
 tqdm.pandas()
 
@@ -24,7 +32,7 @@ clean_folder =  os.path.join(data_folder, "clean")
 ##################################################################
 # Functions
 ##################################################################
-def split_into_chunks(grouped_data, threshold_size):
+def split_into_chunks(grouped_data, threshold_size, costs=None, threshold_cost=None):
 	'''
 	split data set into smaller chunks of data
 
@@ -32,17 +40,123 @@ def split_into_chunks(grouped_data, threshold_size):
 		data set separated by categories 
 	threshold_size : int 
 		maximum number of rows per data chunk
+	costs : dictionary
+		estimated cost of each row, by category (chunks are only limited by size if None)
+	threshold_cost : float
+		maximum estimated cost per data chunk
 	'''
 	chunks = []
 	for key, group in grouped_data.items():
-		if len(group) > threshold_size:
-			n_chunks = ceil(len(group) / threshold_size)
+		n_chunks = ceil(len(group) / threshold_size)
+		if costs is not None:
+			n_chunks = max(n_chunks, ceil(len(group) * costs[key] / threshold_cost))
+		n_chunks = min(n_chunks, len(group))
+		if n_chunks > 1:
 			for chunk in np.array_split(group, n_chunks):
 				chunks.append((key, chunk))
 		else:
 			chunks.append((key, group))
 	return chunks
 
+def run_task(task):
+	'''
+	apply a function to a chunk of data, recording which worker ran it and for how long
+
+	task : tuple
+		position of the chunk, function to apply and its input
+	'''
+	i, func, inp = task
+	start = time.time()
+	result = func(inp)
+	end = time.time()
+	return i, result, os.getpid(), end - start, end
+
+def iterate_tasks(pool, func, inputs, costs, timings=None, groups=None):
+	'''
+	apply a function to chunks of data in a pool of workers, handing out the most costly chunks first as workers become free.
+	chunks of the same group are handed out one after another, in their order in inputs (the most costly groups first), so that workers can reuse what the chunks of a group share.
+	yields the position and result of each chunk as soon as it is done, and prints how busy each worker was at the end
+
+	pool : Pool
+		pool of workers
+	func : func
+		function to apply to each chunk
+	inputs : list
+		input for each chunk
+	costs : list (float)
+		estimated cost of each chunk
+	timings : dict
+		if provided, filled with the worker, run time and transfer time (from the end of the chunk until the parent got its result) of each chunk, by position
+	groups : list
+		group of each chunk (each chunk is its own group if None)
+	'''
+	order = np.argsort(-np.asarray(costs, dtype=float), kind="mergesort")
+	if groups is not None:
+		# Order the groups by their total cost (then by their most costly chunk)
+		group_costs, first = {}, {}
+		for rank, i in enumerate(order):
+			group_costs[groups[i]] = group_costs.get(groups[i], 0) + costs[i]
+			first.setdefault(groups[i], rank)
+		order = sorted(order, key=lambda i: (-group_costs[groups[i]], first[groups[i]], i))
+	start = time.time()
+	workers = {}
+	for i, result, worker, duration, end in pool.imap_unordered(run_task, [(i, func, inputs[i]) for i in order], chunksize=1):
+		n_tasks, busy = workers.get(worker, (0, 0))
+		workers[worker] = (n_tasks + 1, busy + duration)
+		if timings is not None:
+			timings[i] = {"worker": worker, "seconds": duration, "transfer": time.time() - end}
+		yield i, result
+	elapsed = time.time() - start
+
+	print(f"Ran {len(inputs)} chunks in {elapsed:.1f}s:")
+	for worker, (n_tasks, busy) in sorted(workers.items()):
+		print(f"\tWorker {worker}: {n_tasks} chunks, busy {busy:.1f}s ({busy/max(elapsed, 1e-9):.0%})")
+
+def run_tasks(pool, func, inputs, costs, timings=None, groups=None):
+	'''
+	apply a function to chunks of data in a pool of workers with iterate_tasks, and return the results in the original order of the chunks
+
+	pool : Pool
+		pool of workers
+	func : func
+		function to apply to each chunk
+	inputs : list
+		input for each chunk
+	costs : list (float)
+		estimated cost of each chunk
+	timings : dict
+		if provided, filled with the timing of each chunk (see iterate_tasks)
+	groups : list
+		group of each chunk (see iterate_tasks)
+	'''
+	results = [None] * len(inputs)
+	for i, result in iterate_tasks(pool, func, inputs, costs, timings=timings, groups=groups):
+		results[i] = result
+	return results
+
+def write_batches(outfile, results, batch_size=100000):
+	'''
+	append data sets to a csv file as they come, in batches of at least batch_size rows, so that they never need to be held in memory together 
+
+	outfile : string
+		output file (appended to if it exists)
+	results : iterable (DataFrame)
+		data sets to write, with the same columns
+	batch_size : int
+		minimum number of rows to write at once
+	'''
+	batch = []
+	n_rows = 0
+	for result in results:
+		batch.append(result)
+		n_rows += len(result)
+		if n_rows >= batch_size:
+			pd.concat(batch).to_csv(outfile, mode="a", header=not os.path.exists(outfile), index=False)
+			batch = []
+			n_rows = 0
+	if len(batch) > 0:
+		pd.concat(batch).to_csv(outfile, mode="a", header=not os.path.exists(outfile), index=False)
+
 def haversine(lat1, lon1, lat2, lon2):
 	'''
 	calculate the Haversine distance between two points on the earth in kilometers.
@@ -63,6 +177,516 @@ def haversine(lat1, lon1, lat2, lon2):
 	r = 6371  # Radius of earth in kilometers
 	return c * r
 
+def to_unit_sphere(lat_rad, lon_rad):
+	'''
+	convert coordinates to points on the unit sphere, where straight-line distances are increasing in Haversine distances
+
+	lat_rad : array (float)
+		latitude coordinates in radians
+	lon_rad : array (float)
+		longitude coordinates in radians
+	'''
+	lat_rad = np.atleast_1d(np.asarray(lat_rad, dtype=float))
+	lon_rad = np.atleast_1d(np.asarray(lon_rad, dtype=float))
+	cos_lat = np.cos(lat_rad)
+	return np.column_stack([cos_lat*np.cos(lon_rad), cos_lat*np.sin(lon_rad), np.sin(lat_rad)])
+
+def build_spatial_index(data):
+	'''
+	build a KD-tree over the locations of a data set, to be queried with query_spatial_index.
+	locations with missing coordinates are left out (as they are never within any radius), so this returns the tree and the position in the data of each of its points
+
+	data : DataFrame
+		data with "lat_rad" and "lon_rad" columns
+	'''
+	points = to_unit_sphere(data["lat_rad"].values, data["lon_rad"].values)
+	positions = np.flatnonzero(np.isfinite(points).all(axis=1))
+	return cKDTree(points[positions]), positions
+
+def get_chord(radius):
+	'''
+	convert a radius in kilometers to a chord length on the unit sphere, padded slightly so that rounding never drops a point on the boundary (exact distances are computed afterwards anyway)
+
+	radius : float
+		maximum distance in kilometers
+	'''
+	return 2 * np.sin(min(radius / 6371, np.pi) / 2) * (1 + 1e-9)
+
+def count_spatial_index(index, lat_rad, lon_rad, radius):
+	'''
+	count the indexed points that may be within a certain radius of each point, without listing them (0 for points with missing coordinates)
+
+	index : tuple (cKDTree, array)
+		spatial index from build_spatial_index
+	lat_rad : array (float)
+		latitude coordinates in radians
+	lon_rad : array (float)
+		longitude coordinates in radians
+	radius : float
+		maximum distance in kilometers
+	'''
+	tree, _ = index
+	points = to_unit_sphere(lat_rad, lon_rad)
+	valid = np.isfinite(points).all(axis=1)
+	counts = np.zeros(len(points), dtype=np.int64)
+	if valid.any() and tree.n > 0:
+		counts[valid] = tree.query_ball_point(points[valid], get_chord(radius), return_length=True)
+	return counts
+
+def split_by_counts(counts, max_total):
+	'''
+	split a sequence into slices of consecutive elements whose counts add up to at most max_total (or of a single element, if its count is larger).
+	returns the start and end of each slice (a single empty slice if there are no elements)
+
+	counts : array (int)
+		count of each element
+	max_total : int
+		maximum total count of a slice
+	'''
+	totals = np.cumsum(counts)
+	bounds = []
+	start = 0
+	while start < len(totals):
+		end = max(int(np.searchsorted(totals, (totals[start-1] if start > 0 else 0) + max_total, side="right")), start + 1)
+		bounds.append((start, end))
+		start = end
+	return bounds if len(bounds) > 0 else [(0, 0)]
+
+def query_spatial_index(index, lat_rad, lon_rad, radius, max_pairs=2**22):
+	'''
+	get all pairs of (point, indexed point) that may be within a certain radius of each other, as arrays of positions (in the points and in the indexed data).
+	points with missing coordinates have no pairs. the pairs are yielded for slices of points with at most max_pairs pairs in total (see split_by_counts), 
+	so that the pairs of all points are never held in memory at once
+
+	index : tuple (cKDTree, array)
+		spatial index from build_spatial_index
+	lat_rad : array (float)
+		latitude coordinates in radians
+	lon_rad : array (float)
+		longitude coordinates in radians
+	radius : float
+		maximum distance in kilometers
+	max_pairs : int
+		maximum number of pairs to yield at once
+	'''
+	tree, indexed = index
+	points = to_unit_sphere(lat_rad, lon_rad)
+	valid = np.flatnonzero(np.isfinite(points).all(axis=1))
+	if len(valid) == 0 or tree.n == 0:
+		return
+	points = points[valid]
+	chord = get_chord(radius)
+
+	for start, end in split_by_counts(tree.query_ball_point(points, chord, return_length=True), max_pairs):
+		candidates = tree.query_ball_point(points[start:end], chord, return_sorted=True)
+		i = valid[start + np.repeat(np.arange(len(candidates)), [len(c) for c in candidates])]
+		j = indexed[np.concatenate([np.array(c, dtype=int) for c in candidates])]
+		yield i, j
+
+def haversine_block(lat1, lon1, lat2, lon2, radius=None, max_cells=2**22):
+	'''
+	calculate the Haversine distances between every point of one block and every point of another block, 
+	working in tiles of at most max_cells pairs so that large blocks never hold the full distance matrix in memory.
+	returns the full matrix if radius is None, and the (i, j, distance) arrays of pairs within the radius otherwise
+
+	lat1 : array (float)
+		first block latitude coordinates
+	lon1 : array (float)
+		first block longitude coordinates
+	lat2 : array (float)
+		second block latitude coordinates 
+	lon2 : array (float)
+		second block longitude coordinates
+	radius : float
+		maximum distance in kilometers
+	max_cells : int 
+		maximum number of pairs to compute at once
+	'''
+	lat1, lon1, lat2, lon2 = [np.asarray(x, dtype=float) for x in [lat1, lon1, lat2, lon2]]
+	if radius is None:
+		return haversine(lat1[:,None], lon1[:,None], lat2[None,:], lon2[None,:])
+
+	rows_per_tile = max(1, max_cells // max(len(lat2), 1))
+	cols_per_tile = max(1, max_cells // rows_per_tile)
+	pairs = []
+	for row_start in range(0, len(lat1), rows_per_tile):
+		rows = slice(row_start, row_start + rows_per_tile)
+		for col_start in range(0, len(lat2), cols_per_tile):
+			cols = slice(col_start, col_start + cols_per_tile)
+			distance = haversine(lat1[rows,None], lon1[rows,None], lat2[None,cols], lon2[None,cols])
+			i, j = np.nonzero(distance < radius)
+			pairs.append((i + row_start, j + col_start, distance[i, j]))
+
+	if len(pairs) == 0:
+		return np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=float)
+	return tuple(np.concatenate(x) for x in zip(*pairs))
+
+def get_block_neighbours(extensions, controls, radius, index=None, max_cells=2**22):
+	'''
+	for a block of treated properties, get the positions of (and distances to) all controls within a certain radius, excluding the property itself.
+	returns a list with one (positions, distances) tuple per treated property 
+
+	extensions : DataFrame
+		data for treated properties
+	controls : DataFrame
+		data pool from which to pick control properties
+	radius : float
+		maximum distance in kilometers
+	index : tuple (cKDTree, array)
+		spatial index of controls from build_spatial_index. if not provided, distances are computed for every pair
+	max_cells : int 
+		maximum number of distances (and candidate pairs) to compute at once
+	'''
+	lat1, lon1 = extensions["lat_rad"].values.astype(float), extensions["lon_rad"].values.astype(float)
+	lat2, lon2 = controls["lat_rad"].values.astype(float), controls["lon_rad"].values.astype(float)
+
+	if index is not None:
+		# Only compute distances for the candidate pairs found in the spatial index, a slice of at most max_cells pairs at a time
+		pairs = []
+		for i, j in query_spatial_index(index, lat1, lon1, radius, max_pairs=max_cells):
+			distance = haversine(lat1[i], lon1[i], lat2[j], lon2[j])
+			keep = distance < radius
+			pairs.append((i[keep], j[keep], distance[keep]))
+		if len(pairs) == 0:
+			pairs = [(np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=float))]
+		i, j, distance = [np.concatenate(x) for x in zip(*pairs)]
+	else:
+		i, j, distance = haversine_block(lat1, lon1, lat2, lon2, radius=radius, max_cells=max_cells)
+
+	# Remove *this* property from its controls
+	keep = extensions["property_id"].values[i] != controls["property_id"].values[j]
+	i, j, distance = i[keep], j[keep], distance[keep]
+
+	order = np.lexsort((j, i))
+	i, j, distance = i[order], j[order], distance[order]
+	bounds = np.searchsorted(i, np.arange(len(extensions) + 1))
+	return [(j[bounds[k]:bounds[k+1]], distance[bounds[k]:bounds[k+1]]) for k in range(len(extensions))]
+
+def get_neighbour_slices(extensions, pools, radius, max_pairs=2**22):
+	'''
+	split a block of treated properties into slices of consecutive rows with at most max_pairs candidate controls within a radius in total, from all pools (see split_by_counts), 
+	so that the neighbours of only one slice need to be held in memory at once. returns the start and end of each slice
+
+	extensions : DataFrame
+		data for treated properties
+	pools : list (dict)
+		control pools from index_control_pool
+	radius : float
+		maximum distance in kilometers
+	max_pairs : int
+		maximum number of candidate controls in a slice
+	'''
+	lat_rad, lon_rad = extensions["lat_rad"].values.astype(float), extensions["lon_rad"].values.astype(float)
+	counts = sum(count_spatial_index(pool["index"], lat_rad, lon_rad, radius) for pool in pools)
+	return split_by_counts(counts, max_pairs)
+
+def hash_data(data, keys):
+	'''
+	get a content hash of some fields of a data set (which depends on the order of the rows)
+
+	data : DataFrame
+		data to hash
+	keys : list (string)
+		fields to hash
+	'''
+	row_hashes = pd.util.hash_pandas_object(data[keys], index=False).values
+	return hashlib.sha1(row_hashes.tobytes()).hexdigest()
+
+def prepare_neighbour_cache(cache_folder, df, keys=["property_id", "date_trans", "year", "latitude", "longitude", "duration"]):
+	'''
+	get the folder in which to cache neighbours for a data set, and evict the neighbours cached for any other version of the data.
+	the same data gives the same folder, so the cache is shared across runs and scripts
+
+	cache_folder : string
+		folder holding the neighbour cache
+	df : DataFrame
+		data with all properties
+	keys : list (string)
+		fields that identify a version of the data
+	'''
+	fingerprint = hash_data(df, keys)
+	os.makedirs(cache_folder, exist_ok=True)
+	for folder in os.listdir(cache_folder):
+		if folder != fingerprint and os.path.isdir(os.path.join(cache_folder, folder)):
+			print("Evicting stale neighbour cache:", folder)
+			shutil.rmtree(os.path.join(cache_folder, folder))
+
+	folder = os.path.join(cache_folder, fingerprint)
+	os.makedirs(folder, exist_ok=True)
+	return folder
+
+def get_cached_block_neighbours(extensions, pool, radius, cache_folder=None):
+	'''
+	get_block_neighbours for a block of treated properties and a control pool, reusing the neighbours saved by a previous run on the same block if possible. 
+	blocks are identified by a content hash of the locations, years and property IDs of both data sets, so that the cache does not depend on the margin, price variable or time restrictions
+
+	extensions : DataFrame
+		data for treated properties
+	pool : dict
+		control pool from index_control_pool
+	radius : float
+		maximum distance in kilometers
+	cache_folder : string
+		folder from prepare_neighbour_cache (no caching if None)
+	'''
+	if cache_folder is None:
+		return get_block_neighbours(extensions, pool["data"], radius, index=pool["index"])
+
+	key = hashlib.sha1((hash_data(extensions, ["property_id", "lat_rad", "lon_rad"]) + hash_data(pool["data"], ["property_id", "year", "duration", "lat_rad", "lon_rad"]) + str(radius)).encode()).hexdigest()
+	file = os.path.join(cache_folder, f"{key}.npz")
+
+	if os.path.exists(file):
+		try:
+			with np.load(file) as cached:
+				bounds = cached["bounds"]
+				positions = cached["positions"].astype(int)
+				distances = cached["distances"]
+			return [(positions[bounds[k]:bounds[k+1]], distances[bounds[k]:bounds[k+1]]) for k in range(len(bounds) - 1)]
+		except (OSError, KeyError, ValueError):
+			print("Could not read cached neighbours, recomputing:", file)
+
+	neighbours = get_block_neighbours(extensions, pool["data"], radius, index=pool["index"])
+
+	# Save as flat columns, writing to a temporary file first so that an interrupted run never leaves a partial entry
+	bounds = np.r_[0, np.cumsum([len(positions) for positions, _ in neighbours])].astype(np.int64)
+	positions = np.concatenate([positions for positions, _ in neighbours] + [np.array([], dtype=int)]).astype(np.int32)
+	distances = np.concatenate([distances for _, distances in neighbours] + [np.array([], dtype=float)])
+	tmp_file = os.path.join(cache_folder, f"{key}.{os.getpid()}.tmp.npz")
+	np.savez(tmp_file, bounds=bounds, positions=positions, distances=distances)
+	os.replace(tmp_file, file)
+	return neighbours
+
+def same_locations(data1, data2):
+	'''
+	check if two data sets hold the same properties in the same locations (so that their neighbours can be shared)
+
+	data1 : DataFrame
+		first data set
+	data2 : DataFrame
+		second data set
+	'''
+	if data1 is data2:
+		return True
+	if len(data1) != len(data2):
+		return False
+	return all(np.array_equal(data1[key].values, data2[key].values) for key in ["property_id", "lat_rad", "lon_rad"])
+
+def select_neighbours(data, neighbours):
+	'''
+	get subset of a data set given by the positions and distances from get_block_neighbours
+
+	data : DataFrame
+		data from which to pick neighbours
+	neighbours : tuple (array, array)
+		positions and distances of the neighbours 
+	'''
+	positions, distances = neighbours
+	data = data.iloc[positions]
+	data["distance"] = distances
+	return data
+
+def index_control_pool(controls):
+	'''
+	sort a pool of controls by year and duration and index it, so that it can be restricted by location, year and duration without scanning the whole pool.
+	returns a dictionary with the sorted data, its spatial index, the first and last position of each year, and the durations, quarters and months of the controls
+
+	controls : DataFrame
+		data pool from which to pick control properties
+	'''
+	controls = controls.sort_values(["year", "duration"], kind="mergesort")
+	years = controls["year"].values
+	starts = np.flatnonzero(np.r_[True, years[1:] != years[:-1]]) if len(years) > 0 else np.array([], dtype=int)
+	ends = np.r_[starts[1:], len(years)].astype(int)
+
+	pool = {
+		"data": controls,
+		"index": build_spatial_index(controls),
+		"years": {year: (start, end) for year, start, end in zip(years[starts], starts, ends)},
+		"duration": controls["duration"].values.astype(float),
+	}
+	for period in ["quarter", "month"]:
+		if period in controls.columns:
+			pool[period] = controls[period].values
+	return pool
+
+def share_controls(controls, keys=['year', 'area']):
+	'''
+	copy the controls into shared memory once, so that parallel workers can read their control pools without each pool being pickled for every chunk.
+	the controls are sorted so that each pool is a contiguous slice, in the same order as index_control_pool would sort it, and text fields are stored as integer codes.
+	returns the layout of the shared columns (to pass to attach_shared_controls in each worker), the (start, end) offsets of each pool, and the shared memory blocks (to free with release_shared_controls)
+
+	controls : DataFrame
+		data pool from which to pick control properties
+	keys : list (string)
+		fields defining each pool
+	'''
+	controls = controls.sort_values(keys[::-1] + ["duration"], kind="mergesort")
+	offsets = {name: (positions[0], positions[-1] + 1) for name, positions in controls.groupby(keys, sort=False).indices.items()}
+
+	layout = []
+	blocks = []
+	for col in [None] + list(controls.columns):
+		values = controls.index.values if col is None else controls[col].values
+		categories = None
+		if values.dtype.kind not in "biufmM":
+			# Missing values have code -1, which picks the NaN appended to the categories
+			values, categories = pd.factorize(values)
+			categories = np.append(np.asarray(categories, dtype=object), np.nan)
+
+		block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+		np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+		blocks.append(block)
+		layout.append((col, block.name, values.dtype.str, len(values), categories))
+	return layout, offsets, blocks
+
+def release_shared_controls(blocks):
+	'''
+	free the shared memory from share_controls
+
+	blocks : list (SharedMemory)
+		shared memory blocks
+	'''
+	for block in blocks:
+		block.close()
+		block.unlink()
+
+_shared_controls = {}
+
+def attach_shared_controls(layout):
+	'''
+	map the controls from share_controls into a worker (as the initializer of the worker pool)
+
+	layout : list (tuple)
+		name, shared memory block, type, length and categories of each column
+	'''
+	_shared_controls.clear()
+	get_shared_control_pool.cache_clear()
+	for col, name, dtype, length, categories in layout:
+		block = shared_memory.SharedMemory(name=name)
+		values = np.ndarray((length,), dtype=np.dtype(dtype), buffer=block.buf)
+		_shared_controls[col] = (block, values, categories)
+
+@lru_cache(maxsize=16)
+def get_shared_control_pool(start, end):
+	'''
+	get a control pool from the shared controls, indexed with index_control_pool.
+	the last pools are kept, since wrapper hands out the chunks of each area one year after another: enough for the sale and purchase years of the chunks of an area that a worker runs in a row
+
+	start : int
+		first position of the pool in the shared controls
+	end : int
+		last position (exclusive) of the pool in the shared controls
+	'''
+	columns = {}
+	for col, (_, values, categories) in _shared_controls.items():
+		values = values[start:end]
+		if categories is not None:
+			values = categories[values]
+		columns[col] = values
+	index = columns.pop(None)
+	return index_control_pool(pd.DataFrame(columns, index=index))
+
+def as_control_pool(controls):
+	'''
+	index a pool of controls with index_control_pool, unless it has been indexed already
+
+	controls : DataFrame, dict or tuple
+		data pool from which to pick control properties, the output of index_control_pool, or the (start, end) offsets of a pool in the shared controls
+	'''
+	if isinstance(controls, dict):
+		return controls
+	if isinstance(controls, tuple):
+		return get_shared_control_pool(*controls)
+	return index_control_pool(controls)
+
+def restrict_control_pool(pool, neighbours, year=None, duration=None, margin=0.1, quarter=None, month=None):
+	'''
+	get the subset of a set of neighbours in a control pool that transacted in a certain year (and quarter or month), with a duration within a certain margin of a specific lease duration.
+	the year is a dictionary lookup and the duration restriction is a binary search, since the pool is sorted by year and duration
+
+	pool : dict
+		control pool from index_control_pool
+	neighbours : tuple (array, array)
+		sorted positions of (and distances to) the neighbours in the pool 
+	year : int
+		year in which controls must transact (no year or duration restriction if None)
+	duration : float
+		duration to match
+	margin : float
+		maximum acceptable difference between duration (as a share)
+	quarter : int
+		quarter in which controls must transact
+	month : int 
+		month in which controls must transact
+	'''
+	positions, distances = neighbours
+
+	if year is not None:
+		if year not in pool["years"]:
+			return positions[:0], distances[:0]
+		start, end = pool["years"][year]
+
+		# Find the window of durations, widened slightly so that rounding never drops a control (the exact restriction is applied below)
+		width = margin*duration
+		durations = pool["duration"]
+		lo = start + np.searchsorted(durations[start:end], duration - width - 1e-9*(abs(duration) + 1), side="left")
+		hi = start + np.searchsorted(durations[start:end], duration + width + 1e-9*(abs(duration) + 1), side="right")
+
+		# Neighbour positions are sorted, so this window is a slice of them too
+		first, last = np.searchsorted(positions, [lo, hi])
+		positions, distances = positions[first:last], distances[first:last]
+		keep = abs(durations[positions] - duration) <= margin*duration
+		positions, distances = positions[keep], distances[keep]
+
+	if quarter is not None:
+		keep = pool["quarter"][positions] == quarter
+		positions, distances = positions[keep], distances[keep]
+
+	if month is not None:
+		keep = pool["month"][positions] == month
+		positions, distances = positions[keep], distances[keep]
+
+	return positions, distances
+
+def get_matches(pool, positions):
+	'''
+	get the property_id and date_trans of controls, in the order in which they appear in the original data
+
+	pool : dict
+		control pool from index_control_pool
+	positions : array (int)
+		positions of the controls in the pool
+	'''
+	positions = positions[np.argsort(pool["data"].index.values[positions], kind="stable")]
+	pids = pool["data"]["property_id"].values[positions]
+	dates = pool["data"]["date_trans"].values[positions]
+	return pids, dates
+
+def get_matches_table(property_ids, dates, purchase_matches, sale_matches):
+	'''
+	stack the matched controls of a set of treated properties into one table, with a row per control.
+	the purchase (sale) columns are missing for sale (purchase) controls
+
+	property_ids : iterable
+		property_id of each treated property
+	dates : iterable
+		date_trans of each treated property
+	purchase_matches : iterable (tuple)
+		property_ids and dates of the purchase controls of each treated property, from get_matches
+	sale_matches : iterable (tuple)
+		property_ids and dates of the sale controls of each treated property, from get_matches
+	'''
+	columns = {col: [] for col in ['property_id', 'date_trans', 'purchase_controls_pid', 'purchase_controls_date', 'sale_controls_pid', 'sale_controls_date']}
+	for property_id, date, (purchase_pids, purchase_dates), (sale_pids, sale_dates) in zip(property_ids, dates, purchase_matches, sale_matches):
+		n_purchase, n_sale = len(purchase_pids), len(sale_pids)
+		columns['property_id'].append(np.full(n_purchase + n_sale, property_id, dtype=object))
+		columns['date_trans'].append(np.full(n_purchase + n_sale, date, dtype=object))
+		columns['purchase_controls_pid'].extend([purchase_pids, np.full(n_sale, np.nan, dtype=object)])
+		columns['purchase_controls_date'].extend([purchase_dates, np.full(n_sale, np.nan, dtype=object)])
+		columns['sale_controls_pid'].extend([np.full(n_purchase, np.nan, dtype=object), sale_pids])
+		columns['sale_controls_date'].extend([np.full(n_purchase, np.nan, dtype=object), sale_dates])
+	return pd.DataFrame({col: np.concatenate(values).astype(object) if len(values) > 0 else np.array([], dtype=object) for col, values in columns.items()})
+
 def restrict_by_duration(data, duration=None, margin=0.1):
 	'''
 	get subset of a data set that is within a certain margin of a specific lease duration 
@@ -125,7 +749,7 @@ def restrict_by_month(data, month):
 	'''
 	return data.loc[data["month"]==month]
 
-def get_restricted_data(purchase_controls, sale_controls, row, pduration_var='L_duration', sduration_var='whb_duration', margin=0.1, restrict_quarter=False, restrict_month=False, keys=["property_id", "year", "L_year", "quarter", "duration", "L_duration", "distance", "log_price", "L_log_price"] , text=""):
+def get_restricted_data(purchase_controls, sale_controls, row, pduration_var='L_duration', sduration_var='whb_duration', margin=0.1, restrict_quarter=False, restrict_month=False, keys=["property_id", "year", "L_year", "quarter", "duration", "L_duration", "distance", "log_price", "L_log_price"] , text="", verbose=False):
 	'''
 	restrict data so that it has a similar duration and transaction times as the treated property
 
@@ -145,6 +769,8 @@ def get_restricted_data(purchase_controls, sale_controls, row, pduration_var='L_
 		the maximum difference between the treated and control duration 
 	text : string 
 		text to output in verbose setting
+	verbose : bool 
+		flag for whether to add the controls to the text (which is slow)
 	'''
 	purchase_data = restrict_by_year(purchase_controls, year=row["L_year"])
 	purchase_data = restrict_by_duration(purchase_data, margin=margin, duration=row[pduration_var])
@@ -155,8 +781,9 @@ def get_restricted_data(purchase_controls, sale_controls, row, pduration_var='L_
 	if restrict_month:
 		purchase_data = restrict_by_month(purchase_data, month=row["L_month"])
 
-	text += "\n\nPurchase controls:\n"
-	text += str(purchase_data[keys]) + "\n\n"
+	if verbose:
+		text += "\n\nPurchase controls:\n"
+		text += str(purchase_data[keys]) + "\n\n"
 
 	sale_data = restrict_by_year(sale_controls, year=row["year"])
 	sale_data = restrict_by_duration(sale_data, margin=margin, duration=row[sduration_var])
@@ -167,12 +794,457 @@ def get_restricted_data(purchase_controls, sale_controls, row, pduration_var='L_
 	if restrict_month:
 		sale_data = restrict_by_month(sale_data, month=row["month"])
 
-	text += "\n\nSale controls:\n"
-	text += str(sale_data[keys]) + "\n\n"
+	if verbose:
+		text += "\n\nSale controls:\n"
+		text += str(sale_data[keys]) + "\n\n"
 
 	return purchase_data, sale_data, text
 
-def wrapper(df, price_var='log_price', real_time=None, pduration_var='L_duration', sduration_var='whb_duration', restrict_quarter=False, restrict_month=False, restrictions=[0.1,0.5,1,5,10,20], margin=0.1, extension_var='extension', func=None, parallelize=True, restrict_both_years=False, necessary_fields = list(set(["property_id", "date_trans", "postcode", "lat_rad", "lon_rad", "duration", "L_duration","year", "L_year", "quarter", "L_quarter", "area", "duration10yr", "outcode", "log_price", "L_log_price"]))):
+def get_extension_signatures(extensions, controls, pool_keys=['year', 'area'], params=[]):
+	'''
+	get a signature for each extension, which changes whenever the extension, its purchase or sale control pool, or the parameters of the control search change
+
+	extensions : DataFrame
+		data for treated properties
+	controls : DataFrame
+		data for control properties
+	pool_keys : list (string)
+		keys defining the control pools, with the sale year first (the purchase pool uses L_year instead)
+	params : list 
+		parameters of the control search
+	'''
+	pool_hashes = {name if isinstance(name, tuple) else (name,): hash_data(group, sorted(group.columns)) for name, group in controls.groupby(pool_keys)}
+	row_hashes = pd.util.hash_pandas_object(extensions, index=False).values
+	sale_pools = list(zip(*[extensions[key] for key in pool_keys]))
+	purchase_pools = list(zip(*[extensions['L_year' if key=='year' else key] for key in pool_keys]))
+
+	signatures = []
+	for row_hash, sale_pool, purchase_pool in zip(row_hashes, sale_pools, purchase_pools):
+		signature = f"{row_hash}|{pool_hashes.get(sale_pool)}|{pool_hashes.get(purchase_pool)}|{params}"
+		signatures.append(hashlib.sha1(signature.encode()).hexdigest())
+	return signatures
+
+def load_manifest(manifest_file):
+	'''
+	load the manifest of extensions computed in previous runs (empty if there is none)
+
+	manifest_file : string
+		manifest file
+	'''
+	if not os.path.exists(manifest_file):
+		return pd.DataFrame(columns=["property_id", "date_trans", "signature"], dtype=str)
+	return pd.read_csv(manifest_file, dtype=str)
+
+def get_unchanged_extensions(current, previous):
+	'''
+	get the subset of the current manifest with the same signature as in a previous manifest
+
+	current : DataFrame
+		property_id, date_trans and signature of the current extensions
+	previous : DataFrame
+		property_id, date_trans and signature of the extensions computed in previous runs
+	'''
+	keys = ["property_id", "date_trans", "signature"]
+	is_unchanged = pd.MultiIndex.from_frame(current[keys]).isin(pd.MultiIndex.from_frame(previous[keys]))
+	return current.loc[is_unchanged]
+
+def check_manifest(manifest_file, outfiles):
+	'''
+	discard the manifest of previous runs if any of their outputs is missing, so that everything is recomputed 
+
+	manifest_file : string
+		manifest file
+	outfiles : list (string)
+		output files of the previous runs
+	'''
+	if os.path.exists(manifest_file) and not all(os.path.exists(outfile) for outfile in outfiles):
+		print("Missing outputs, discarding manifest:", manifest_file)
+		os.remove(manifest_file)
+
+def update_output(outfile, new_rows, manifest_file=None, keys=["property_id", "date_trans"]):
+	'''
+	save the output of a run, keeping the rows of the existing output for extensions that did not need to be recomputed (when running with a manifest)
+
+	outfile : string
+		output file 
+	new_rows : DataFrame
+		output for the extensions computed in this run
+	manifest_file : string
+		manifest file passed to wrapper (full output if None)
+	keys : list (string)
+		keys identifying an extension
+	'''
+	if isinstance(new_rows, str):
+		return update_output_file(outfile, new_rows, manifest_file=manifest_file, keys=keys)
+
+	if manifest_file is not None and os.path.exists(outfile):
+		unchanged = get_unchanged_extensions(pd.read_csv(f"{manifest_file}.pending", dtype=str), load_manifest(manifest_file))
+		existing = pd.read_csv(outfile, dtype={key: str for key in keys})
+		existing = existing.loc[pd.MultiIndex.from_frame(existing[keys]).isin(pd.MultiIndex.from_frame(unchanged[keys]))]
+		print(f"Keeping {len(existing)} rows of {outfile}, adding {len(new_rows)}.")
+		if len(new_rows) > 0:
+			new_rows = pd.concat([existing, new_rows])
+		else:
+			new_rows = existing
+	new_rows.to_csv(outfile, index=False)
+
+def update_output_file(outfile, new_file, manifest_file=None, keys=["property_id", "date_trans"], chunksize=100000):
+	'''
+	update_output for an output streamed to a file by wrapper, reading both files in chunks so that neither needs to fit in memory
+
+	outfile : string
+		output file 
+	new_file : string
+		output_file passed to wrapper, with the output for the extensions computed in this run (removed once merged)
+	manifest_file : string
+		manifest file passed to wrapper (full output if None)
+	keys : list (string)
+		keys identifying an extension
+	chunksize : int
+		number of rows to read at once
+	'''
+	if manifest_file is None or not os.path.exists(outfile):
+		if os.path.exists(new_file):
+			os.replace(new_file, outfile)
+		else:
+			print(f"No output to save to {outfile}.")
+		return
+
+	unchanged = get_unchanged_extensions(pd.read_csv(f"{manifest_file}.pending", dtype=str), load_manifest(manifest_file))
+	unchanged = pd.MultiIndex.from_frame(unchanged[keys])
+
+	# Write the rows to keep and the new rows to a temporary file, replacing the output only once it is complete
+	tmp_file = f"{outfile}.tmp"
+	if os.path.exists(tmp_file):
+		os.remove(tmp_file)
+	n_kept = 0
+	for existing in pd.read_csv(outfile, dtype=str, keep_default_na=False, chunksize=chunksize):
+		existing = existing.loc[pd.MultiIndex.from_frame(existing[keys]).isin(unchanged)]
+		n_kept += len(existing)
+		existing.to_csv(tmp_file, mode="a", header=not os.path.exists(tmp_file), index=False)
+
+	n_new = 0
+	if os.path.exists(new_file):
+		for new_rows in pd.read_csv(new_file, dtype=str, keep_default_na=False, chunksize=chunksize):
+			n_new += len(new_rows)
+			new_rows.to_csv(tmp_file, mode="a", header=not os.path.exists(tmp_file), index=False)
+		os.remove(new_file)
+	print(f"Keeping {n_kept} rows of {outfile}, adding {n_new}.")
+	os.replace(tmp_file, outfile)
+
+def commit_manifest(manifest_file):
+	'''
+	record the extensions computed in this run as done, once all outputs have been saved with update_output
+
+	manifest_file : string
+		manifest file passed to wrapper
+	'''
+	os.replace(f"{manifest_file}.pending", manifest_file)
+
+def start_trace(trace):
+	'''
+	set up tracing of the control search for some treated properties, clearing the output of previous runs.
+	returns the settings to pass to should_trace and write_trace (None if there is no tracing)
+
+	trace : dict
+		with keys "file" (JSONL file to write), and "property_ids" (list of treated properties to trace) and/or "sample" (share of treated properties to trace)
+	'''
+	if trace is None:
+		return None
+	trace = {"file": trace["file"], "property_ids": set(trace.get("property_ids", [])), "sample": trace.get("sample", 0)}
+	folder = os.path.dirname(os.path.abspath(trace["file"]))
+	os.makedirs(folder, exist_ok=True)
+	for file in os.listdir(folder):
+		if file == os.path.basename(trace["file"]) or (file.startswith(os.path.basename(trace["file"]) + ".") and file.endswith(".part")):
+			os.remove(os.path.join(folder, file))
+	return trace
+
+def should_trace(property_id, trace):
+	'''
+	check if a treated property is traced. the sample is drawn from a hash of the property ID, so it is the same in every run and in every worker
+
+	property_id : string
+		treated property
+	trace : dict
+		settings from start_trace
+	'''
+	if property_id in trace["property_ids"]:
+		return True
+	return trace["sample"] > 0 and int(hashlib.sha1(str(property_id).encode()).hexdigest()[:8], 16) < trace["sample"] * 16**8
+
+def write_trace(trace, record):
+	'''
+	write a record to the trace. each process writes to its own part of the file, which finish_trace puts together
+
+	trace : dict
+		settings from start_trace
+	record : dict
+		record to write
+	'''
+	with open(f"{trace['file']}.{os.getpid()}.part", "a") as f:
+		f.write(json.dumps(record, default=lambda x: x.item() if hasattr(x, "item") else str(x)) + "\n")
+
+def finish_trace(trace):
+	'''
+	put together the parts of the trace written by each process
+
+	trace : dict
+		settings from start_trace
+	'''
+	if trace is None:
+		return
+	folder = os.path.dirname(os.path.abspath(trace["file"]))
+	parts = sorted(file for file in os.listdir(folder) if file.startswith(os.path.basename(trace["file"]) + ".") and file.endswith(".part"))
+	n_records = 0
+	with open(trace["file"], "a") as f:
+		for part in parts:
+			with open(os.path.join(folder, part)) as p:
+				for line in p:
+					f.write(line)
+					n_records += 1
+			os.remove(os.path.join(folder, part))
+	print(f"Wrote {n_records} records to {trace['file']}.")
+
+@contextmanager
+def profile_stage(stages, stage):
+	'''
+	add the time spent in a block of code to a stage of the profile (does nothing if stages is None)
+
+	stages : dict
+		seconds spent in each stage
+	stage : string
+		stage to add the time to
+	'''
+	if stages is None:
+		yield
+		return
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		stages[stage] = stages.get(stage, 0) + time.perf_counter() - start
+
+def start_profile(profile):
+	'''
+	set up profiling of the control search, clearing the output of previous runs.
+	returns the settings to pass to the function applied to each chunk, which writes one record per chunk with write_trace (None if there is no profiling)
+
+	profile : string
+		JSON file to write the profile report to
+	'''
+	if profile is None:
+		return None
+	settings = start_trace({"file": os.path.splitext(profile)[0] + "_chunks.jsonl"})
+	settings["report"] = profile
+	return settings
+
+def write_profile(profile, stages, chunks=None):
+	'''
+	put together the records of each chunk and write the profile report: the time spent in each stage of wrapper, and in each stage of the search
+	(attaching control pools, distance computation, restriction filtering, aggregation and transfer of results) in total, by worker and by (year, L_year, area) group.
+	groups are listed slowest first, with their candidate pool sizes
+
+	profile : dict
+		settings from start_profile
+	stages : dict
+		seconds spent in each stage of wrapper
+	chunks : list (dict)
+		group, input size and timing (from iterate_tasks) of each chunk run in a pool of workers (None if not parallelized)
+	'''
+	if profile is None:
+		return
+	finish_trace(profile)
+	keys = ["year", "L_year", "partition"]
+	search_stages = ["pools", "distance", "restriction", "aggregation", "other"]
+	if os.path.exists(profile["file"]) and os.path.getsize(profile["file"]) > 0:
+		records = pd.read_json(profile["file"], lines=True, dtype=False)
+	else:
+		records = pd.DataFrame(columns=keys + ["worker", "n_extensions", "n_purchase_pool", "n_sale_pool", "n_purchase_candidates", "n_sale_candidates", "pool_hits", "pool_misses", "seconds"] + search_stages)
+	records[search_stages + ["pool_hits", "pool_misses"]] = records[search_stages + ["pool_hits", "pool_misses"]].fillna(0)
+
+	sums = {col: "sum" for col in ["n_extensions", "n_purchase_candidates", "n_sale_candidates", "pool_hits", "pool_misses", "seconds"] + search_stages}
+	groups = records.groupby(keys, dropna=False).agg(n_chunks=("seconds", "size"), n_purchase_pool=("n_purchase_pool", "first"), n_sale_pool=("n_sale_pool", "first"), **{col: (col, agg) for col, agg in sums.items()}).reset_index()
+	workers = records.groupby("worker").agg(n_chunks=("seconds", "size"), **{col: (col, agg) for col, agg in sums.items()}).reset_index()
+
+	# The transfer of results is timed by the parent process
+	if chunks:
+		chunks = pd.DataFrame(chunks)
+		groups = groups.merge(chunks.groupby(keys, dropna=False)[["input_bytes", "transfer"]].sum().reset_index(), on=keys, how="left")
+		workers = workers.merge(chunks.groupby("worker")[["transfer"]].sum().reset_index(), on="worker", how="left")
+	groups = groups.sort_values("seconds", ascending=False, kind="mergesort")
+	totals = records[["seconds"] + search_stages].sum().to_dict()
+	if chunks is not None and len(chunks) > 0:
+		totals["transfer"] = chunks["transfer"].sum()
+
+	# How often the workers found the pools of a chunk already attached
+	pool_hits, pool_misses = int(records["pool_hits"].sum()), int(records["pool_misses"].sum())
+	pool_cache = {"hits": pool_hits, "misses": pool_misses, "hit_rate": pool_hits / max(pool_hits + pool_misses, 1)}
+
+	# Go through to_json so that missing values are written as null
+	report = {
+		"wrapper": stages,
+		"search": {stage: float(seconds) for stage, seconds in totals.items()},
+		"pool_cache": pool_cache,
+		"workers": json.loads(workers.to_json(orient="records")),
+		"groups": json.loads(groups.to_json(orient="records")),
+		"slowest_groups": json.loads(groups[keys].head(10).to_json(orient="values")),
+	}
+	with open(profile["report"], "w") as f:
+		json.dump(report, f, indent=1)
+
+	print(f"Profile of the control search saved to {profile['report']}.")
+	print(f"Control pool cache: {pool_hits} hits and {pool_misses} misses ({pool_cache['hit_rate']:.0%} hit rate). Slowest groups:")
+	print(groups.head(10)[keys + ["n_extensions", "n_purchase_pool", "n_sale_pool", "seconds"] + search_stages].to_string(index=False))
+
+def get_variant_columns(variant, restrictions):
+	'''
+	get the names of the columns holding the indices (or the matched controls) for one variant of the control search 
+
+	variant : dict
+		variant of the control search, with a "tag" key (and optionally a "matches" key)
+	restrictions : list (float)
+		the radii within which to look for controls
+	'''
+	if variant.get("matches", False):
+		return [f"purchase_controls{variant['tag']}", f"sale_controls{variant['tag']}"]
+	prefixes=["L_", ""]
+	return [f"{prefix}{var}_{restriction}_km{variant['tag']}" for restriction in restrictions for prefix in prefixes for var in ["index", "duration_idx"]]
+
+def get_variant_extensions(extensions, variant, new_cols, restrictions, priced_pools=None, partition_var='area'):
+	'''
+	get the results of one variant of the control search: the extensions with the variant's price variable (and with control pools that have it, if parallelized), with the variant's columns untagged
+
+	extensions : DataFrame
+		results of the control search for all variants
+	variant : dict
+		variant of the control search
+	new_cols : list (string)
+		columns of all variants
+	restrictions : list (float)
+		the radii within which to look for controls
+	priced_pools : dict
+		control pools with each price variable (None if not parallelized)
+	partition_var : string
+		variable identifying the control pools with the year
+	'''
+	variant_extensions = extensions.loc[~extensions[variant["price_var"]].isna()]
+	if priced_pools is not None:
+		pools = priced_pools[variant["price_var"]]
+		has_pools = pd.MultiIndex.from_arrays([variant_extensions["year"], variant_extensions[partition_var]]).isin(pools) & pd.MultiIndex.from_arrays([variant_extensions["L_year"], variant_extensions[partition_var]]).isin(pools)
+		variant_extensions = variant_extensions.loc[has_pools]
+		if partition_var == 'tile':
+			variant_extensions = variant_extensions.drop(columns=['tile'])
+
+	variant_cols = get_variant_columns(variant, restrictions)
+	untagged_cols = get_variant_columns({**variant, "tag": ""}, restrictions)
+	variant_extensions = variant_extensions.drop(columns=[col for col in new_cols if col not in variant_cols])
+	return variant_extensions.rename(columns=dict(zip(variant_cols, untagged_cols)))
+
+def stream_matches(results, matches_files, variants, new_cols, restrictions, priced_pools=None, partition_var='area', batch_size=100000):
+	'''
+	write the matched controls of "matches" variants to csv files as the results of each chunk come (one row per control, see get_matches_table), in batches of at least batch_size rows.
+	yields the results of each chunk without the matched controls, so that they are never all held in memory
+
+	results : iterable (tuple)
+		position and results of each chunk, from iterate_tasks
+	matches_files : dict (string)
+		csv file for each "matches" variant, by tag (appended to if it exists)
+	variants : list (dict)
+		variants of the control search
+	new_cols : list (string)
+		columns of all variants
+	restrictions : list (float)
+		the radii within which to look for controls
+	priced_pools : dict
+		control pools with each price variable (None if not parallelized)
+	partition_var : string
+		variable identifying the control pools with the year
+	batch_size : int
+		minimum number of rows to write at once
+	'''
+	matches_variants = [variant for variant in variants if variant["tag"] in matches_files]
+	matches_cols = [col for variant in matches_variants for col in get_variant_columns(variant, restrictions)]
+	batches = {variant["tag"]: [] for variant in matches_variants}
+	n_rows = {variant["tag"]: 0 for variant in matches_variants}
+	for i, result in results:
+		for variant in matches_variants:
+			tag = variant["tag"]
+			matched = get_variant_extensions(result, variant, new_cols, restrictions, priced_pools=priced_pools, partition_var=partition_var)
+			batches[tag].append(get_matches_table(matched["property_id"], matched["date_trans"], matched["purchase_controls"], matched["sale_controls"]))
+			n_rows[tag] += len(batches[tag][-1])
+			if n_rows[tag] >= batch_size:
+				write_batches(matches_files[tag], batches[tag], batch_size=batch_size)
+				batches[tag], n_rows[tag] = [], 0
+		yield i, result.drop(columns=matches_cols)
+	for variant in matches_variants:
+		write_batches(matches_files[variant["tag"]], batches[variant["tag"]], batch_size=batch_size)
+
+def get_tiles(lat_rad, lon_rad, tile_size, ref_lat):
+	'''
+	get the grid coordinates of some locations, in a grid of tiles roughly tile_size kilometers wide
+
+	lat_rad : array (float)
+		latitude coordinates in radians
+	lon_rad : array (float)
+		longitude coordinates in radians
+	tile_size : float
+		width of each tile in kilometers
+	ref_lat : float
+		latitude (in radians) at which tiles are exactly tile_size kilometers wide
+	'''
+	tile_lat = tile_size / 6371
+	tile_lon = tile_size / (6371 * np.cos(ref_lat))
+	return np.floor(np.asarray(lat_rad) / tile_lat).astype(np.int64), np.floor(np.asarray(lon_rad) / tile_lon).astype(np.int64)
+
+def tile_data(extensions, controls, tile_size, radius):
+	'''
+	partition the data in a geographic grid, where each tile's control pool includes a halo with all controls within a certain radius of the tile.
+	the "tile" of each extension is the tile it is in, while controls are repeated once for every tile whose halo they are in (only for tiles with extensions)
+
+	extensions : DataFrame
+		data for treated properties
+	controls : DataFrame
+		data for control properties
+	tile_size : float
+		width of each tile in kilometers
+	radius : float
+		width of the halo in kilometers (the largest radius within which to look for controls)
+	'''
+	# Locations with missing coordinates are never within any radius: such controls are dropped, and such extensions are all put in a tile of their own, without a control pool
+	located = np.isfinite(extensions["lat_rad"].values.astype(float)) & np.isfinite(extensions["lon_rad"].values.astype(float))
+	controls = controls.loc[np.isfinite(controls["lat_rad"].values.astype(float)) & np.isfinite(controls["lon_rad"].values.astype(float))]
+
+	ref_lat = np.median(extensions["lat_rad"].values[located]) if located.any() else 0
+	tile_lat = tile_size / 6371
+	tile_lon = tile_size / (6371 * np.cos(ref_lat))
+
+	# The halo must hold every control within the radius. Latitude differences are at most radius/6371, while longitude differences are largest at the highest latitude
+	max_lat = min(max(np.abs(extensions["lat_rad"].values[located]).max(initial=0), np.abs(controls["lat_rad"].values).max(initial=0)) + radius / 6371, np.pi/2 - 1e-6)
+	halo_lat = radius / 6371 * (1 + 1e-9)
+	halo_lon = 2 * np.arcsin(min(np.sin(radius / 6371 / 2) / np.cos(max_lat), 1)) * (1 + 1e-9)
+
+	extensions = extensions.copy()
+	tile_y, tile_x = get_tiles(extensions["lat_rad"].values[located], extensions["lon_rad"].values[located], tile_size, ref_lat)
+	extensions["tile"] = np.iinfo(np.int64).min
+	extensions.loc[located, "tile"] = tile_y * 2**32 + tile_x
+
+	# Find the range of tiles whose halo each control is in, and repeat the control for each of them
+	lat, lon = controls["lat_rad"].values, controls["lon_rad"].values
+	first_y, last_y = np.floor((lat - halo_lat) / tile_lat).astype(np.int64), np.floor((lat + halo_lat) / tile_lat).astype(np.int64)
+	first_x, last_x = np.floor((lon - halo_lon) / tile_lon).astype(np.int64), np.floor((lon + halo_lon) / tile_lon).astype(np.int64)
+	tiled = []
+	for offset_y in range((last_y - first_y).max() + 1 if len(controls) > 0 else 0):
+		for offset_x in range((last_x - first_x).max() + 1):
+			keep = (first_y + offset_y <= last_y) & (first_x + offset_x <= last_x)
+			tile = (first_y[keep] + offset_y) * 2**32 + first_x[keep] + offset_x
+			in_use = np.isin(tile, extensions["tile"].values)
+			tiled.append(controls.loc[keep].loc[in_use].assign(tile=tile[in_use]))
+
+	if len(tiled) == 0:
+		return extensions, controls.assign(tile=np.array([], dtype=np.int64))
+	return extensions, pd.concat(tiled).sort_index(kind="mergesort")
+
+def wrapper(df, price_var='log_price', real_time=None, pduration_var='L_duration', sduration_var='whb_duration', restrict_quarter=False, restrict_month=False, restrictions=[0.1,0.5,1,5,10,20], margin=0.1, extension_var='extension', func=None, parallelize=True, restrict_both_years=False, variants=None, cache_folder=None, manifest_file=None, partition='area', tile_size=None, output_file=None, matches_files=None, trace=None, profile=None, num_processes=None, necessary_fields = list(set(["property_id", "date_trans", "postcode", "lat_rad", "lon_rad", "duration", "L_duration","year", "L_year", "quarter", "L_quarter", "area", "duration10yr", "outcode", "log_price", "L_log_price"]))):
 	'''
 	set up data to get controls
 	
@@ -180,6 +1252,8 @@ def wrapper(df, price_var='log_price', real_time=None, pduration_var='L_duration
 		data with all properties
 	price_var : string
 		outcome variable to report for controls
+	real_time : int
+		if provided, only compute the extensions sold in this year (for real-time updates)
 	pduration_var : string 
 		purchase duration key 
 	sduration_var : string 
@@ -194,13 +1268,52 @@ def wrapper(df, price_var='log_price', real_time=None, pduration_var='L_duration
 		flag identifying extended properties
 	func : func
 		function to apply to data
+	variants : list (dict)
+		outcome variables and time restrictions to compute from a single search, as dictionaries with keys "tag", "price_var" and (optionally) "restrict_quarter" and "restrict_month". 
+		variants with "matches" set to True report the matched controls instead of the indices (see get_controls).
+		if provided, price_var, restrict_quarter and restrict_month are ignored and a dictionary of results by tag is returned
+	cache_folder : string
+		folder in which to cache the neighbours of each extension across runs (no caching if None)
+	manifest_file : string
+		manifest of the extensions computed in previous runs. if provided, only new or changed extensions (or those whose control pools changed) are computed, 
+		and the outputs should be saved with update_output and then commit_manifest.
+		with real_time, the outputs of the extensions in other years are kept as they were
+	partition : string
+		how to split the data into control pools when parallelizing: "area" uses the area codes, and "grid" uses a grid of tiles, 
+		each with a halo holding all controls within the largest radius (so that controls across area borders are found as well)
+	tile_size : float
+		width of the tiles in kilometers if partition is "grid" (twice the largest radius if None)
+	output_file : string
+		csv file to which the output of each chunk is appended as soon as it is computed, so that the whole output is never held in memory (returned if None).
+		the output should then be saved with update_output, and this cannot be used with variants
+	matches_files : dict (string)
+		csv file for some "matches" variants, by tag, to which their matched controls are appended as soon as each chunk is computed (see stream_matches), instead of being returned.
+		the outputs should then be saved with update_output
+	trace : dict
+		settings to trace the control search for some treated properties (see start_trace), recording the controls found within every radius to a JSONL file (no tracing if None)
+	profile : string
+		JSON file to write a profile of the control search to, with the time spent in each stage by worker and by group, the candidate pool sizes and the slowest groups (see write_profile). 
+		each chunk is also recorded to a JSONL file next to it (no profiling if None)
+	num_processes : int
+		number of processes to use if parallelizing (all cores if None)
 	necessary_fields : list (string)
 		data fields to keep (to make data lighter)
 	'''
 
-	# Drop if missing main price variable
-	df = df[~df[price_var].isna()]
-	df[price_var] = df[price_var].astype(float)
+	start = time.time()
+	return_variants = variants is not None
+	if not return_variants:
+		variants = [{"tag": "", "price_var": price_var, "restrict_quarter": restrict_quarter, "restrict_month": restrict_month}]
+	price_vars = list(dict.fromkeys(variant["price_var"] for variant in variants))
+
+	# Identify the version of the data before any restrictions, so that the neighbour cache is shared by all scripts using it
+	if cache_folder is not None:
+		cache_folder = prepare_neighbour_cache(cache_folder, df, keys=["property_id", "date_trans", "year", "latitude", "longitude", "duration", extension_var])
+
+	# Drop if missing all price variables
+	df = df[df[price_vars].notna().any(axis=1)]
+	for var in price_vars:
+		df[var] = df[var].astype(float)
 
 	df["lat_rad"] = np.deg2rad(df["latitude"])
 	df["lon_rad"] = np.deg2rad(df["longitude"])
@@ -209,6 +1322,7 @@ def wrapper(df, price_var='log_price', real_time=None, pduration_var='L_duration
 	controls = df.loc[df[extension_var]==0]
 
 	# If we're doing the real-time updates, we only need the last year 
+	all_extensions = extensions[["property_id", "date_trans"]].astype(str)
 	if real_time:
 		extensions = extensions[extensions.year==real_time]
 
@@ -230,29 +1344,70 @@ def wrapper(df, price_var='log_price', real_time=None, pduration_var='L_duration
 	print(controls[['property_id', 'year', 'L_year', 'duration', 'L_duration']])
 
 	# Keep only necessary fields to speed up the process
-	necessary_fields = list(set(necessary_fields + [price_var]))
+	necessary_fields = list(set(necessary_fields + price_vars))
 	controls = controls[necessary_fields]
 
 	# Sort restrictions backwards:
 	restrictions.sort(reverse=True)
 
-	prefixes=["L_", ""]
-	new_cols = [f"{prefix}{var}_{restriction}_km" for restriction in restrictions for prefix in prefixes for var in ["index", "duration_idx"]]
+	new_cols = [col for variant in variants for col in get_variant_columns(variant, restrictions)]
+
+	# Partition the data by area, or in a grid of tiles with halos
+	partition_var = 'area'
+	if parallelize and partition == 'grid':
+		partition_var = 'tile'
+		if tile_size is None:
+			tile_size = 2*max(restrictions)
+		extensions, controls = tile_data(extensions, controls, tile_size, max(restrictions))
+
+	# Skip the extensions that were already computed in a previous run
+	if manifest_file is not None:
+		params = [variants, sorted(restrictions), margin, pduration_var, sduration_var, extension_var, parallelize, func.__name__] + ([partition, tile_size] if partition != 'area' else [])
+		pool_keys = ['year', partition_var] if parallelize else ['year']
+		current = extensions[["property_id", "date_trans"]].astype(str)
+		current["signature"] = get_extension_signatures(extensions, controls, pool_keys=pool_keys, params=params)
+		previous = load_manifest(manifest_file)
+		unchanged = get_unchanged_extensions(current, previous)
+
+		is_unchanged = current.index.isin(unchanged.index)
+		print(f"Reusing {is_unchanged.sum()} extensions from previous runs, computing {(~is_unchanged).sum()}.")
+
+		# With real-time updates, keep the previous entries of the extensions in other years (which are not computed in this run), so that update_output keeps their rows
+		pending = current
+		if real_time:
+			previous_keys = pd.MultiIndex.from_frame(previous[["property_id", "date_trans"]])
+			is_other_year = previous_keys.isin(pd.MultiIndex.from_frame(all_extensions)) & ~previous_keys.isin(pd.MultiIndex.from_frame(current[["property_id", "date_trans"]]))
+			print(f"Keeping {is_other_year.sum()} extensions from other years.")
+			pending = pd.concat([current, previous.loc[is_other_year]])
+		pending.to_csv(f"{manifest_file}.pending", index=False)
+		extensions = extensions.loc[~is_unchanged]
+
+	for file in [output_file] + list((matches_files or {}).values()):
+		if file is not None and os.path.exists(file):
+			os.remove(file)
+	# Control pools with each price variable, to tell which extensions each variant has results for
+	priced_pools = {var: list(controls.loc[~controls[var].isna()].groupby(['year', partition_var]).groups) for var in price_vars} if parallelize and return_variants else None
+	trace = start_trace(trace)
+	profile = start_profile(profile)
+	stages = {"setup": time.time() - start}
+	chunks = None
 
 	print("Creating price index:")
-	if parallelize:
-		num_processes = int(os.cpu_count())
-		pool = Pool(num_processes)
+	if len(extensions) == 0:
+		print("No extensions to compute.")
+		extensions = extensions.reindex(columns=list(extensions.columns) + new_cols)
+
+	elif parallelize:
+		num_processes = int(num_processes if num_processes is not None else os.cpu_count())
 		print("Number of cores:", num_processes)
 
-		# Split and group by year
-		threshold_size = np.minimum(len(extensions)/num_processes, 500) # Adjust this based on your desired chunk size
-		extensions_grouped = split_into_chunks({name: group for name, group in extensions.groupby(['year', 'L_year', 'area'])}, threshold_size)
-		controls_grouped = {name: group for name, group in controls.groupby(['year', 'area'])}
+		# Put the controls in shared memory once, so that each chunk only carries the offsets of its control pools
+		layout, controls_grouped, blocks = share_controls(controls, keys=['year', partition_var])
 
-		dfs = []
+		# Drop extensions without control pools
+		extensions_grouped = {}
 		count = 0
-		for name, group in extensions_grouped:
+		for name, group in extensions.groupby(['year', 'L_year', partition_var]):
 			sale_year = name[0]
 			purchase_year = name[1]
 			area = name[2]
@@ -260,15 +1415,78 @@ def wrapper(df, price_var='log_price', real_time=None, pduration_var='L_duration
 			if (sale_year, area) not in controls_grouped or (purchase_year, area) not in controls_grouped:
 				count += 1
 				continue
+			extensions_grouped[name] = group
+
+		# Estimate the cost of each extension as the number of candidate controls, and split the groups so that no chunk is much costlier than the rest
+		pool_sizes = {name: end - start for name, (start, end) in controls_grouped.items()}
+		costs = {}
+		for name in extensions_grouped:
+			sale_year, purchase_year, area = name
+			costs[name] = pool_sizes[(sale_year, area)] + (pool_sizes[(purchase_year, area)] if purchase_year != sale_year else 0)
+		total_cost = sum(len(group) * costs[name] for name, group in extensions_grouped.items())
+		threshold_size = np.minimum(len(extensions)/num_processes, 500) # Adjust this based on your desired chunk size
+		threshold_cost = max(total_cost / (4 * num_processes), 1)
+		extensions_grouped = split_into_chunks(extensions_grouped, threshold_size, costs=costs, threshold_cost=threshold_cost)
+
+		# Hand out the chunks of each area (or tile) one after another, by year and purchase year, so that workers find the pools of the previous years in the cache of get_shared_control_pool
+		dfs = []
+		chunk_costs = []
+		chunk_groups = []
+		for name, group in extensions_grouped:
+			sale_year = name[0]
+			purchase_year = name[1]
+			area = name[2]
 
-			inp = (group, controls_grouped[(sale_year, area)], controls_grouped[(purchase_year, area)], new_cols, price_var, pduration_var, sduration_var, restrict_quarter, restrict_month, restrict_both_years, margin)
+			inp = (group, controls_grouped[(sale_year, area)], controls_grouped[(purchase_year, area)], new_cols, price_var, pduration_var, sduration_var, restrict_quarter, restrict_month, restrict_both_years, margin, variants, cache_folder, trace, profile)
 			dfs.append(inp)
+			chunk_costs.append(len(group) * costs[name])
+			chunk_groups.append(area)
 		print(f'Missing controls for {count}.')
 
-		extensions = pd.concat(pool.map(func, dfs, chunksize=1))
+		timings = {} if profile is not None else None
+		search_start = time.time()
+		try:
+			with Pool(num_processes, initializer=attach_shared_controls, initargs=(layout,)) as pool:
+				if output_file is not None:
+					write_batches(output_file, (result for _, result in iterate_tasks(pool, func, dfs, chunk_costs, timings=timings, groups=chunk_groups)))
+				elif matches_files is not None:
+					results = [None] * len(dfs)
+					for i, result in stream_matches(iterate_tasks(pool, func, dfs, chunk_costs, timings=timings, groups=chunk_groups), matches_files, variants, new_cols, restrictions, priced_pools=priced_pools, partition_var=partition_var):
+						results[i] = result
+					extensions = pd.concat(results)
+				else:
+					extensions = pd.concat(run_tasks(pool, func, dfs, chunk_costs, timings=timings, groups=chunk_groups))
+		finally:
+			release_shared_controls(blocks)
+		stages["search"] = time.time() - search_start
+
+		if profile is not None:
+			chunks = [{"year": name[0], "L_year": name[1], "partition": name[2], "input_bytes": len(pickle.dumps(group)), **timings[i]} for i, (name, group) in enumerate(extensions_grouped)]
 
 	else:
-		inp = (extensions, controls, controls, new_cols, price_var, pduration_var, sduration_var, restrict_quarter, restrict_month, restrict_both_years, margin)
+		search_start = time.time()
+		controls_pool = index_control_pool(controls)
+		inp = (extensions, controls_pool, controls_pool, new_cols, price_var, pduration_var, sduration_var, restrict_quarter, restrict_month, restrict_both_years, margin, variants, cache_folder, trace, profile)
 		extensions = func(inp, restrictions=restrictions)
+		if output_file is not None:
+			write_batches(output_file, [extensions])
+		elif matches_files is not None:
+			extensions = list(stream_matches([(0, extensions)], matches_files, variants, new_cols, restrictions))[0][1]
+		stages["search"] = time.time() - search_start
+
+	finish_trace(trace)
+	write_profile(profile, stages, chunks)
+
+	if output_file is not None:
+		return
+
+	if not return_variants:
+		return extensions.drop(columns=['tile'], errors='ignore') if partition_var == 'tile' else extensions
 
-	return extensions
+	# Split the results by variant, keeping only extensions with the variant's price variable (and with control pools that have it, if parallelized)
+	results = {}
+	for variant in variants:
+		if matches_files is not None and variant["tag"] in matches_files:
+			continue
+		results[variant["tag"]] = get_variant_extensions(extensions, variant, [col for col in new_cols if col in extensions.columns], restrictions, priced_pools=priced_pools, partition_var=partition_var)
+	return results